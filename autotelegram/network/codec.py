@@ -0,0 +1,111 @@
+"""
+This module contains the JSON codecs used to encode request bodies and decode responses.
+Codecs work on bytes directly, so no intermediate str is built on either side.
+The orjson and msgspec codecs are only available when the respective package is installed,
+`get_codec` picks the fastest one available and falls back to the standard library.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+__all__ = ("JSONCodec","OrjsonCodec","MsgspecCodec","get_codec")
+
+
+class JSONCodec:
+    """
+    JSON codec backed by the standard library json module.
+    Args:
+        default (callable): called with objects that can't be serialized, it should return a
+            serializable version of the object or raise TypeError.
+    """
+    name = "json"
+
+    def __init__ (self,default = None):
+        self.default = default
+
+    def loads (self,data:bytes):
+        """
+        decode a JSON document from bytes
+        """
+        return json.loads(data)
+
+    def dumps (self,obj) -> bytes:
+        """
+        encode obj to a JSON document in bytes
+        """
+        return json.dumps(obj,default = self.default,ensure_ascii = False,separators = (",",":")).encode()
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    JSON codec backed by orjson
+    """
+    name = "orjson"
+
+    def __init__ (self,default = None):
+        if orjson is None:
+            raise ImportError("OrjsonCodec requires the orjson package")
+        super().__init__(default)
+
+    def loads (self,data:bytes):
+        return orjson.loads(data)
+
+    def dumps (self,obj) -> bytes:
+        return orjson.dumps(obj,default = self.default)
+
+
+class MsgspecCodec(JSONCodec):
+    """
+    JSON codec backed by msgspec
+    """
+    name = "msgspec"
+
+    def __init__ (self,default = None):
+        if msgspec is None:
+            raise ImportError("MsgspecCodec requires the msgspec package")
+        super().__init__(default)
+        self._encoder = msgspec.json.Encoder(enc_hook = default)
+        self._decoder = msgspec.json.Decoder()
+
+    def loads (self,data:bytes):
+        return self._decoder.decode(data)
+
+    def dumps (self,obj) -> bytes:
+        return self._encoder.encode(obj)
+
+
+_codecs = {
+    "orjson":OrjsonCodec,
+    "msgspec":MsgspecCodec,
+    "json":JSONCodec,
+}
+
+def get_codec (name:str = None,default = None) -> JSONCodec:
+    """
+    Returns a codec instance. With a `name` of "orjson", "msgspec" or "json" that codec is
+    returned, else the fastest installed codec is picked in that order.
+    Args:
+        name (str): name of the codec to use
+        default (callable): passed on to the codec, see JSONCodec
+    Raises:
+        ValueError: the name is not a known codec
+        ImportError: the package backing the named codec is not installed
+    """
+    if name is not None:
+        try:
+            return _codecs[name](default)
+        except KeyError:
+            raise ValueError(f"unknown codec {name}, pick one of {', '.join(_codecs)}")
+    if orjson is not None:
+        return OrjsonCodec(default)
+    if msgspec is not None:
+        return MsgspecCodec(default)
+    return JSONCodec(default)
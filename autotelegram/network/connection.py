@@ -5,36 +5,205 @@ httpx to implement the protocol api
 """
 
 import httpx
-from autotelegram.network.protocol import HTTP
+from contextlib import asynccontextmanager
+from autotelegram.network.protocol import HTTP,TransportError
+from autotelegram.network.codec import get_codec
+from autotelegram.network.multipart import MultipartStream
 
 class HTTPConnection(HTTP):
+    """
+    httpx based implementation of the HTTP protocol. All requests made through a connection
+    share one connection pool, whose policy can be tuned through the constructor arguments.
 
-    def __init__ (self):
-        
-        self.client = httpx.AsyncClient()
+    Args:
+        max_connections (int): maximum number of connections the pool may open at once. Defaults to 100.
+        max_keepalive_connections (int): maximum number of idle connections kept alive in the pool. Defaults to 20.
+        keepalive_expiry (float): seconds an idle connection is kept alive before it is closed. Defaults to 5.0.
+        http2 (bool): multiplex requests over HTTP/2 connections. Requires the `h2` package, installed with the
+            `http2` extra. Defaults to False.
+        connect_timeout (float): seconds to wait for a connection to be established. Defaults to 5.0.
+        read_timeout (float): seconds to wait for a chunk of the response to be received. Defaults to 5.0.
+        write_timeout (float): seconds to wait for a chunk of the request to be sent. Defaults to 5.0.
+        pool_timeout (float): seconds to wait for a free connection from the pool. Defaults to 5.0.
+        uds (str): path of a Unix domain socket to connect through instead of TCP. Use it to reach a bot API
+            server running on the same host without the TCP and TLS overhead. Urls should then use the
+            http scheme, the host in the url is only sent in the Host header.
+        codec (JSONCodec): codec encoding request bodies. Defaults to the fastest codec installed.
+        transport (httpx.AsyncBaseTransport): custom transport to use instead of the pooled one. The pool
+            arguments are ignored when a transport is passed.
+    """
 
-    async def get (self,url:str,params:dict = None) -> dict:
+    def __init__ (self,*,
+        max_connections = 100,
+        max_keepalive_connections = 20,
+        keepalive_expiry = 5.0,
+        http2 = False,
+        connect_timeout = 5.0,
+        read_timeout = 5.0,
+        write_timeout = 5.0,
+        pool_timeout = 5.0,
+        uds = None,
+        codec = None,
+        transport = None
+    ):
+
+        self.limits = httpx.Limits(
+            max_connections = max_connections,
+            max_keepalive_connections = max_keepalive_connections,
+            keepalive_expiry = keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(
+            connect = connect_timeout,
+            read = read_timeout,
+            write = write_timeout,
+            pool = pool_timeout
+        )
+        self.http2 = http2
+        self.codec = codec if codec else get_codec()
+        self.uds = uds
+        self._own_transport = not transport
+        self._transport = transport if transport else self._make_transport()
+        self.client = httpx.AsyncClient(transport = self._transport,timeout = self.timeout)
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+
+    def options (self) -> dict:
+        """
+        Returns the keyword arguments building a connection with the same pool policy, for example in
+        another process. A custom transport and the codec are left out.
+        """
+        return {
+            "max_connections":self.limits.max_connections,
+            "max_keepalive_connections":self.limits.max_keepalive_connections,
+            "keepalive_expiry":self.limits.keepalive_expiry,
+            "http2":self.http2,
+            "connect_timeout":self.timeout.connect,
+            "read_timeout":self.timeout.read,
+            "write_timeout":self.timeout.write,
+            "pool_timeout":self.timeout.pool,
+            "uds":self.uds,
+        }
+
+    def _make_transport (self) -> httpx.AsyncHTTPTransport:
+        return httpx.AsyncHTTPTransport(http2 = self.http2,limits = self.limits,uds = self.uds)
+
+    async def _send (self,method:str,url:str,**kwargs) -> httpx.Response:
+        """
+        send a request through the client while keeping count of the requests in flight.
+        httpx transport errors are raised as TransportError
         """
-        concrete implementation of get
+        self._requests += 1
+        self._in_flight += 1
+        if self._in_flight > self._peak_in_flight:
+            self._peak_in_flight = self._in_flight
+        try:
+            return await self.client.request(method,url,**kwargs)
+        except httpx.TransportError as exp:
+            raise TransportError(str(exp)) from exp
+        finally:
+            self._in_flight -= 1
+
+    async def get (self,url:str,params:dict = None,timeout:float = None) -> dict:
         """
-        if params:
-            response = await self.client.get(url,params = params)
-        response = await self.client.get(url)
+        concrete implementation of get. `timeout` overrides the read timeout for this request only,
+        which lets long running requests such as long polls outlive the pool's read timeout.
+        """
+        if timeout is None:
+            response = await self._send("GET",url,params = params)
+        else:
+            request_timeout = httpx.Timeout(
+                connect = self.timeout.connect,
+                read = timeout,
+                write = self.timeout.write,
+                pool = self.timeout.pool
+            )
+            response = await self._send("GET",url,params = params,timeout = request_timeout)
         return response.content
 
 
-    async def post (self,url:str,headers:dict = None,body:dict = None) -> dict:
+    async def post (self,url:str,headers:dict = None,body:dict = None,files:dict = None) -> dict:
         """
-        concrete implementation of post
+        concrete implementation of post. The body is encoded straight to bytes by the codec.
+        When `files` are given the request is streamed as multipart/form-data instead, with
+        every body value that is not a str sent as JSON.
         """
-        if body:
-            if headers:
-                response = await self.client.post(url,headers = headers, json = body)
-            response = await self.client.post(url,json = body)
+        if files:
+            fields = {}
+            for key,value in (body or {}).items():
+                fields[key] = value.encode() if isinstance(value,str) else self.codec.dumps(value)
+            stream = MultipartStream(fields,files)
+            headers = {**headers,**stream.headers} if headers else stream.headers
+            response = await self._send("POST",url,headers = headers,content = stream)
+        elif body is None:
+            response = await self._send("POST",url,headers = headers)
+        else:
+            headers = {"content-type":"application/json",**headers} if headers else {"content-type":"application/json"}
+            response = await self._send("POST",url,headers = headers,content = self.codec.dumps(body))
         return response.content
 
+    @asynccontextmanager
+    async def stream (self,url:str,headers:dict = None):
+        """
+        concrete implementation of stream. The connection used by the response goes back to the
+        pool when the context exits. The yielded httpx.Response exposes `status_code`, `headers`,
+        `aread()` and `aiter_bytes(chunk_size)`
+        """
+        self._requests += 1
+        self._in_flight += 1
+        if self._in_flight > self._peak_in_flight:
+            self._peak_in_flight = self._in_flight
+        try:
+            async with self.client.stream("GET",url,headers = headers) as response:
+                yield response
+        except httpx.TransportError as exp:
+            raise TransportError(str(exp)) from exp
+        finally:
+            self._in_flight -= 1
+
+    def pool_stats (self) -> dict:
+        """
+        Returns a snapshot of the connection pool occupancy. Use it to size `max_connections`
+        against the rate at which the bot sends requests.
+        Returns:
+            dict: with the keys
+                max_connections, max_keepalive_connections: the configured pool limits
+                connections: number of connections currently open in the pool, None with a custom transport
+                idle_connections: number of open connections not serving a request, None with a custom transport
+                in_flight: number of requests currently awaiting a response
+                peak_in_flight: highest number of requests in flight seen so far
+                requests: total number of requests sent
+        """
+        connections = idle = None
+        # httpx has no public pool statistics, they are read from the httpcore pool behind the private
+        # _pool of the transports the connection opens itself, and left unknown if it is missing
+        pool = getattr(self._transport,"_pool",None) if self._own_transport else None
+        if pool is not None and hasattr(pool,"connections"):
+            connections = list(pool.connections)
+            idle = sum(1 for conn in connections if conn.is_idle())
+            connections = len(connections)
+        return {
+            "max_connections":self.limits.max_connections,
+            "max_keepalive_connections":self.limits.max_keepalive_connections,
+            "connections":connections,
+            "idle_connections":idle,
+            "in_flight":self._in_flight,
+            "peak_in_flight":self._peak_in_flight,
+            "requests":self._requests,
+        }
+
     async def close (self):
         """
         concrete implementation of close
         """
         await self.client.aclose()
+
+    async def reset (self):
+        """
+        concrete implementation of reset. The client is closed along with the connections of its pool
+        and replaced by a new one, on a new pool unless a custom transport was passed
+        """
+        await self.client.aclose()
+        if self._own_transport:
+            self._transport = self._make_transport()
+        self.client = httpx.AsyncClient(transport = self._transport,timeout = self.timeout)
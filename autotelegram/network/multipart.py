@@ -0,0 +1,79 @@
+"""
+This module contains a streaming multipart/form-data encoder used to upload files.
+Files are read and sent one chunk at a time, so uploads never hold a whole file in memory.
+"""
+import os
+import secrets
+
+__all__ = ("MultipartStream",)
+
+
+class MultipartStream:
+    """
+    Async iterable producing a multipart/form-data body.
+
+    Args:
+        fields (dict): form fields, mapping field names to bytes
+        files (dict): file fields, mapping field names to files. A file is any object with `filename`,
+            `mime_type` and `size` attributes that can be iterated asynchronously for its bytes chunks.
+            `size` is None when the length of the file is not known beforehand.
+    """
+
+    def __init__ (self,fields:dict,files:dict):
+        self.boundary = secrets.token_hex(16)
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self._fields = [(self._part_header(name),value) for name,value in fields.items()]
+        self._files = [(self._part_header(name,file),file) for name,file in files.items()]
+        self._end = b"--" + self.boundary.encode() + b"--\r\n"
+
+    def _part_header (self,name,file = None) -> bytes:
+        disposition = 'Content-Disposition: form-data; name="' + _quote(name) + '"'
+        if file is None:
+            return ("--" + self.boundary + "\r\n" + disposition + "\r\n\r\n").encode()
+        return ("--" + self.boundary + "\r\n" + disposition
+                + '; filename="' + _quote(file.filename) + '"\r\n'
+                + "Content-Type: " + file.mime_type + "\r\n\r\n").encode()
+
+    @property
+    def content_length (self) -> int|None:
+        """
+        length of the body in bytes, or None if the size of one of the files is unknown
+        """
+        length = len(self._end)
+        for header,value in self._fields:
+            length += len(header) + len(value) + 2
+        for header,file in self._files:
+            if file.size is None:
+                return None
+            length += len(header) + file.size + 2
+        return length
+
+    @property
+    def headers (self) -> dict:
+        """
+        the content type and, when it is known, content length headers of the body
+        """
+        headers = {"content-type":self.content_type}
+        length = self.content_length
+        if length is not None:
+            headers["content-length"] = str(length)
+        return headers
+
+    async def __aiter__ (self):
+        for header,value in self._fields:
+            yield header
+            yield value
+            yield b"\r\n"
+        for header,file in self._files:
+            yield header
+            async for chunk in file:
+                yield chunk
+            yield b"\r\n"
+        yield self._end
+
+
+def _quote (value) -> str:
+    """
+    escape a name so it can be used inside a quoted header parameter
+    """
+    return os.fspath(value).replace("\\","\\\\").replace('"',"%22").replace("\r","%0D").replace("\n","%0A")
@@ -7,29 +7,48 @@ The Concrete subclasses should implement the given methods
 from typing import Protocol
 from abc import abstractmethod
 
+class TransportError(Exception):
+    """
+    raised by connections when a request fails before a response is received, such as
+    on connection errors, timeouts and malformed responses
+    """
+
 class HTTP (Protocol):
     """
     Base abstraction class for the HTTP Protocol
     """
 
     @abstractmethod
-    async def get (self,url:str,headers:dict = None) -> dict:
+    async def get (self,url:str,headers:dict = None,timeout:float = None) -> dict:
         """
         abstract get method
         """
 
     @abstractmethod
-    async def post (self,url:str,headers:dict = None,body:dict = None) -> dict:
+    async def post (self,url:str,headers:dict = None,body:dict = None,files:dict = None) -> dict:
         """
         abstract post method
         """
 
+    @abstractmethod
+    def stream (self,url:str,headers:dict = None):
+        """
+        abstract stream method. Returns an async context manager yielding the response of a get
+        request as soon as its headers are received, so that its body can be read in chunks
+        """
+
     @abstractmethod
     async def close (self):
         """
         abstract close method
         """
 
+    async def reset (self):
+        """
+        drop the open connections after a transport error, so the next request opens a new one.
+        Does nothing by default
+        """
+
 class WebSocket:
     """
     Base abstraction class for the Websocket protocol
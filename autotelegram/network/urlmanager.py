@@ -1,36 +1,43 @@
 """
 This module handles construction of urls needed for making queries
 """
-from urllib.parse import urlsplit,urlunsplit
+from urllib.parse import urlencode
 
-__all__ = ("UrlManager")
+__all__ = ("UrlManager",)
 
 class UrlManager:
+    """
+    Builds the bot API urls of a bot. The url of every method is built the first time it is
+    requested and cached in a per method table, so later lookups are a single dictionary access
+    and no shared state is modified while requests are being made.
+    """
 
-    def __init__ (self,token):
-        self.token = "bot" + str(token) + "/"
-        self.url_parts = ["https","api.telegram.org","","",""]
-        self.url = "/".join((urlunsplit(self.url_parts),self.token))
+    def __init__ (self,token,base_url = "https://api.telegram.org"):
+        self.bot_token = str(token)
+        self.token = "bot" + self.bot_token + "/"
+        self.base_url = base_url.rstrip("/")
+        self.url = self.base_url + "/" + self.token
+        self.file_base_url = self.base_url + "/file/" + self.token
+        self._methods = {}
 
     def add_method (self,other):
         """
-        append other part onto the url string
+        returns the url of the bot API method `other`
         """
-        sch,netloc,path,qry,frag = urlsplit(self.url)
         try:
-            base,method = path.split("/")
-        except ValueError:
-            prev,base,method = path.split("/")
-        path = "/".join([base,other])
-        self.url = urlunsplit((sch,netloc,path,qry,frag))
-        return self.url
+            return self._methods[other]
+        except KeyError:
+            url = self._methods[other] = self.url + other
+            return url
 
-    def add_query (self,**kwargs):
+    def file_url (self,file_path):
         """
-        append queries to the query part of the url
+        returns the download url of a file from the `file_path` given by getFile
         """
-        params = ["=".join([str(k),str(v)]) for k,v in kwargs.items()]
-        qry_string = "&".join(params)
-        sch,netloc,path,qry,frag = urlsplit(self.url)
-        qry = qry_string
-        return urlunsplit([sch,netloc,path,qry,frag])
\ No newline at end of file
+        return self.file_base_url + file_path.lstrip("/")
+
+    def add_query (self,url = None,**kwargs):
+        """
+        returns `url`, or the base url of the bot when not given, with kwargs as its query string
+        """
+        return (url if url else self.url) + "?" + urlencode(kwargs)
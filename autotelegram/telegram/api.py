@@ -443,7 +443,7 @@ class BotAPI:
         """
         url = self.url.add_method("getFile")
         res = await self._post(url = url,body = kwargs)
-        return self.parser.parse(res)
+        return self.parser.parse(res,"file")
 
     async def ban_chat_member(self, **kwargs) -> bool:
         """Use this method to ban a user in a group, a supergroup or a channel. In the case of supergroups and channels, the user will not be able to return to the chat on their own using invite links, etc., unless unbanned first. The bot must be an administrator in the chat for this to work and must have the appropriate administrator rights.
@@ -1012,8 +1012,34 @@ class BotAPI:
             Update: Returns a list of Updates on success
         """
         url = self.url.add_method("getUpdates")
-        res = await self._get(url = url,headers = kwargs)
+        res = await self._poll(url = url,params = kwargs)
         return [self.parser.parse(update) for update in res]
+
+    async def set_webhook (self,**kwargs) -> bool:
+        """Use this method to specify a URL and receive incoming updates via an outgoing webhook. Whenever there is an update for the bot, we will send an HTTPS POST request to the specified URL, containing a JSON-serialized Update. Returns True on success.
+
+        Args:
+            url (str): HTTPS URL to send updates to. Use an empty string to remove webhook integration
+            certificate (InputFile | None, optional): Upload your public key certificate so that the root certificate in use can be checked. Defaults to None.
+            ip_address (str | None, optional): The fixed IP address which will be used to send webhook requests instead of the IP address resolved through DNS. Defaults to None.
+            max_connections (int | None, optional): The maximum allowed number of simultaneous HTTPS connections to the webhook for update delivery, 1-100. Defaults to 40.
+            allowed_updates (list[str] | None, optional): A JSON-serialized list of the update types you want your bot to receive. Specify an empty list to receive all update types except chat_member. If not specified, the previous setting will be used.
+            drop_pending_updates (bool | None, optional): Pass True to drop all pending updates. Defaults to None.
+            secret_token (str | None, optional): A secret token to be sent in a header “X-Telegram-Bot-Api-Secret-Token” in every webhook request, 1-256 characters. Defaults to None.
+        """
+        url = self.url.add_method("setWebhook")
+        await self._post(url = url,body = kwargs)
+        return True
+
+    async def delete_webhook (self,**kwargs) -> bool:
+        """Use this method to remove webhook integration if you decide to switch back to getUpdates. Returns True on success.
+
+        Args:
+            drop_pending_updates (bool | None, optional): Pass True to drop all pending updates. Defaults to None.
+        """
+        url = self.url.add_method("deleteWebhook")
+        await self._post(url = url,body = kwargs)
+        return True
     
     async def edit_message_text (self,**kwargs):
         """
@@ -1,19 +1,45 @@
 
 import asyncio
-from starlette.requests import Request
-from autotelegram.telegram.context import Context
+import hmac
+import inspect
+import os
+import signal
+from time import monotonic,time
+from autotelegram.telegram.catchup import CatchUp
+from autotelegram.network.protocol import TransportError
+from autotelegram.telegram.context import Context,DeferredCall
+from autotelegram.telegram.dispatcher import Dispatcher,update_date
+from autotelegram.telegram.errors import TelegramResultError
+from autotelegram.telegram.flowcontrol import FlowControl
+from autotelegram.telegram.multiprocess import ProcessPoller
+from autotelegram.telegram.retry import RetryPolicy
+from autotelegram.telegram.stalefilter import StaleFilter
 
 __all__ = ("BaseApp","PollingApp","WebhookApp")
 
+_overflow_policies = ("wait","drop","reject")
+
+# update types telegram sends when allowed_updates is an empty list
+_default_updates = (
+    "message","edited_message","channel_post","edited_channel_post","inline_query","chosen_inline_result",
+    "callback_query","shipping_query","pre_checkout_query","poll","poll_answer","my_chat_member","chat_join_request",
+)
+
 
 class BaseApp (object):
     """
     Base class for the telegram application.
+    Args:
+        context (Context): The bot context
+        stale_filter (StaleFilter): Optional. filter dropping or rerouting stale updates before they are parsed
     """
-    def __init__ (self,context:Context) -> None:
+    def __init__ (self,context:Context,*,stale_filter:StaleFilter = None) -> None:
         self._context = context
         self._commandhandlers = {}
+        self._updatehandlers = {}
         self._errorhandlers = {}
+        self._callback = None
+        self.stale_filter = stale_filter
 
     def add_commandhandler (self,command:str):
         """
@@ -25,6 +51,8 @@ class BaseApp (object):
 
         def handler_func (callback):
             self._commandhandlers[command] = callback
+            self._handlers_changed()
+            return callback
 
         return handler_func
     
@@ -42,105 +70,764 @@ class BaseApp (object):
             self._commandhandlers.pop(command)
         except KeyError:
             raise ValueError(f"command {command} was not registered.")
-        
+        self._handlers_changed()
+
+    def add_updatehandler (self,update_type:str):
+        """
+        Registers a coroutine function to be called for every update of a type, such as "callback_query"
+        or "edited_message", instead of the application callback. The handler is called with the update
+        and the bot context.
+        Args:
+            update_type (str): name of the field of the Update object the handler processes
+        """
+
+        def handler_func (callback):
+            self._updatehandlers[update_type] = callback
+            self._handlers_changed()
+            return callback
+
+        return handler_func
+
+    def remove_updatehandler (self,update_type):
+        """
+        Remove the handler of an update type from the register.
+        Args:
+            update_type (str): update type to remove from handler table
+        Raises:
+            ValueError
+        """
+
+        try:
+            self._updatehandlers.pop(update_type)
+        except KeyError:
+            raise ValueError(f"update type {update_type} was not registered.")
+        self._handlers_changed()
+
+    @property
+    def allowed_updates (self) -> list[str]:
+        """
+        The update types the registered handlers consume, sent as `allowed_updates` so telegram doesn't send
+        the others. While the application has a callback, which receives every update, it is an empty list,
+        meaning every type telegram sends by default, or the default types plus the handler types when a
+        handler consumes a type telegram only sends on request, such as "chat_member".
+        """
+        update_types = set(self._updatehandlers)
+        if self._callback is not None:
+            if update_types <= set(_default_updates):
+                return []
+            update_types.update(_default_updates)
+        if self._commandhandlers:
+            update_types.add("message")
+        return sorted(update_types)
+
+    def _handlers_changed (self):
+        """
+        called whenever a handler is added or removed
+        """
 
     def add_errorhandler (self,exception,handler):
         """
-        Adds an exception handler function to the application class. The handler is called with
-        the raised exception
+        Adds an exception handler function to the application class. The handler, a function or a coroutine
+        function, is called with the raised exception. It also handles the subclasses of exception, an exception
+        goes to the handler of its most specific class, following its MRO.
         """
         self._errorhandlers[exception] = handler
 
-    async def _process_update (self,update,callback):
+    async def _handle_error (self,exp) -> bool:
+        """
+        call the error handler registered for the closest class of exp, returns False if there is none
+        """
+        for cls in type(exp).__mro__:
+            handler = self._errorhandlers.get(cls)
+            if handler is not None:
+                result = handler(exp)
+                if inspect.isawaitable(result):
+                    await result
+                return True
+        return False
+
+    async def _report_error (self,exp,update_id):
+        """
+        pass an exception raised while processing an update to the error handlers, or to the exception
+        handler of the event loop when none matches, which logs it
+        """
         try:
-            msg = update.message.text
-            if msg.startswith("/"):
-                try:
-                    cmd_handler = self._commandhandlers[msg]
-                    await cmd_handler(msg,self._context)
-                except KeyError:
-                    await callback(update,self._context)
-            else:
-                await callback(update,self._context)
-        except AttributeError:
-            """
-            message is None, so we assume there are other attributes such as
-            callback query or poll so we call the callback to process the update
-            """
-            await callback(update,self._context)
+            if await self._handle_error(exp):
+                return
+        except Exception as error:
+            exp = error
+        asyncio.get_running_loop().call_exception_handler({
+            "message":f"exception while processing update {update_id}",
+            "exception":exp,
+        })
+
+    async def _safe_process (self,update,callback,reply = False):
+        """
+        process update, an exception raised by its handler is reported and doesn't reach the caller,
+        so it only fails this update. A deferred call returned by the handler is returned when reply
+        is True, else it is sent.
+        """
+        try:
+            result = await self._process_update(update,callback)
+            if isinstance(result,DeferredCall):
+                if reply:
+                    return result
+                await self._context.send_deferred(result)
+        except Exception as exp:
+            await self._report_error(exp,getattr(update,"update_id",None))
+        return None
+
+    def __getstate__ (self):
+        # the context holds open connections, worker processes build their own
+        state = self.__dict__.copy()
+        state["_context"] = None
+        return state
+
+    async def _process_update (self,update,callback):
+        message = getattr(update,"message",None)
+        text = getattr(message,"text",None)
+        if text is not None and text.startswith("/") and text in self._commandhandlers:
+            return await self._commandhandlers[text](text,self._context)
+        for update_type,handler in self._updatehandlers.items():
+            if getattr(update,update_type,None) is not None:
+                return await handler(update,self._context)
+        if callback is not None:
+            # the callback processes every other update, such as callback queries or polls
+            return await callback(update,self._context)
 
 class PollingApp(BaseApp):
     """
     Implementation of the polling update method for bot applications. This application runs in a loop
-    while making periodic requests to the bot API to poll for updates. Once updates are received, they are
-    then processed.
+    while long polling the bot API for updates. Once updates are received, they are then processed.
+
+    Args:
+        context (Context): The bot context
+        concurrency (int): Optional. number of updates processed concurrently.
+        queue_size (int): maximum number of updates waiting on each worker, polling pauses while
+            a queue is full. Defaults to 100.
+        catchup (CatchUp): Optional. settings of the catch-up phase run before long polling starts.
+        stale_filter (StaleFilter): Optional. filter dropping or rerouting stale updates before they are parsed.
+        flow_control (FlowControl): Optional. adapts the batch size and the cadence of polls to the backlog of updates
+            and the latency of the handlers, and stops polling past a high water mark.
+        drain_timeout (int | float): seconds `stop` waits for the updates already received to be processed. Defaults to 30.
+        retry_policy (RetryPolicy): Optional. backoff between failed polls. Defaults to a RetryPolicy without a limit
+            of attempts, polls are repeated until they succeed unless the policy has max_attempts.
     """
 
-    async def _runner (self,callback,wait_for):
+    def __init__ (self,context:Context,*,concurrency = None,queue_size = 100,catchup:CatchUp = None,
+                  stale_filter:StaleFilter = None,flow_control:FlowControl = None,drain_timeout = 30,
+                  retry_policy:RetryPolicy = None) -> None:
+        super().__init__(context,stale_filter = stale_filter)
+        self._offset = None
+        self._inflight = set()
+        self._progress = None
+        self._received = None
+        self._allowed_updates = None
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.catchup = catchup
+        self.flow_control = flow_control
+        self.drain_timeout = drain_timeout
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy(max_attempts = None)
+        self._stopping = None
+        self._drain_expired = False
+        self._drain_deadline = None
+        self._task = None
+
+    @property
+    def offset (self) -> int|None:
+        """
+        offset of the next poll: the oldest update being processed, else the update after the last one received
+        """
+        if self._inflight:
+            return min(self._inflight)
+        return self._offset
 
+    async def _fetch (self,timeout,wait_for,limit = None) -> tuple[int,list[dict]]:
+        """
+        fetch the next batch of raw updates, confirming the updates processed before.
+        Updates received before are skipped and stale updates are filtered out of the batch.
+        Returns the number of new updates received, stale ones included, and the batch.
+        """
+        if wait_for:
+            await asyncio.sleep(wait_for)
+        if limit is None and self.flow_control is not None:
+            limit = await self.flow_control.acquire(lambda:len(self._inflight),self.concurrency or 1)
+        params = {"timeout":timeout}
+        if limit is not None:
+            params["limit"] = limit
+        url = self._context.url.add_method("getUpdates")
+        while True:
+            self._progress.clear()
+            if self._inflight and self._offset - min(self._inflight) >= params.get("limit",100):
+                # a poll could only bring back updates being processed
+                await self._progress.wait()
+                continue
+            if self.offset is not None:
+                params["offset"] = self.offset
+            allowed_updates = self.allowed_updates
+            if allowed_updates != self._allowed_updates:
+                # telegram keeps the last setting, so it is only sent when the handlers changed
+                params["allowed_updates"] = allowed_updates
+            else:
+                params.pop("allowed_updates",None)
+            received = await self._poll(url,params)
+            self._allowed_updates = allowed_updates
+            updates = received
+            if self._offset is not None:
+                # updates below _offset were received before and are still being processed
+                updates = [update for update in received if update["update_id"] >= self._offset]
+            if updates or not received:
+                break
+            await self._progress.wait()
+
+        received = len(updates)
+        if updates:
+            self._offset = max(update["update_id"] for update in updates) + 1
+            if self.stale_filter is not None:
+                updates = await self.stale_filter.filter(updates,self._context,self._report_error)
+        return received,updates
+
+    async def _poll (self,url,params) -> list[dict]:
+        """
+        make a getUpdates request, repeating it with backoff as the retry policy decides
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await self._context._poll(url = url,params = params)
+            except (TelegramResultError,TransportError) as exp:
+                delay = self.retry_policy.delay(exp,attempt)
+                if delay is None:
+                    raise
+                if isinstance(exp,TransportError):
+                    # the poll connection may be broken, the next attempt opens a new one
+                    await self._context.poll_connection.reset()
+            await asyncio.sleep(delay)
+
+    def _received_batch (self,updates):
+        """
+        track a batch of raw updates until they are processed
+        """
+        if updates:
+            self._inflight.update(update["update_id"] for update in updates)
+            self._received = updates[-1]["update_id"]
+
+    def _finished (self,update_id,latency = None):
+        """
+        commit the highest update_id every update up to which was processed to the offset store
+        """
+        self._inflight.discard(update_id)
+        if self._progress is not None:
+            self._progress.set()
+        store = self._context.offset_store
+        if store is not None:
+            store.commit(min(self._inflight) - 1 if self._inflight else self._received)
+        if self.flow_control is not None:
+            self.flow_control.finished(latency)
+
+    async def _process (self,update,callback):
+        start = monotonic()
+        await self._safe_process(update,callback)
+        self._finished(update.update_id,monotonic() - start)
+
+    async def _parse (self,update):
+        """
+        returns the Update object of a raw update, or None if it can't be parsed, in which case the error
+        is reported and the update counts as processed
+        """
+        try:
+            return self._context.parser.parse(update)
+        except Exception as exp:
+            await self._report_error(exp,update["update_id"])
+            self._finished(update["update_id"])
+            return None
+
+    async def _catch_up (self,callback):
+        """
+        short poll and process the pending updates until none are left
+        """
+        catchup = self.catchup
+        stats = {"batches":0,"received":0,"processed":0,"stale":0,"dropped":0,"summarized":0}
+        stale = []
+
+        async def process (update):
+            await self._process(update,callback)
+            stats["processed"] += 1
+
+        dispatcher = Dispatcher(process,catchup.concurrency,self.queue_size)
+        dispatcher.start()
+        fetch = asyncio.ensure_future(self._fetch(0,0,100))
         try:
             while True:
-                updates = await self._context.get_updates()
+                batch = await self._next_batch(fetch,dispatcher)
+                # the backlog is drained once a poll brings nothing, not once a batch is all stale
+                if batch is None or not batch[0]:
+                    break
+                received,updates = batch
+                fetch = asyncio.ensure_future(self._fetch(0,0,100))
+                stats["batches"] += 1
+                stats["received"] += received
+                self._received_batch(updates)
+                now = time()
+                for update in updates:
+                    stale_update = catchup.is_stale(update_date(update),now)
+                    if stale_update:
+                        stats["stale"] += 1
+                        if catchup.stale_policy == "drop":
+                            stats["dropped"] += 1
+                            self._finished(update["update_id"])
+                            continue
+                    update = await self._parse(update)
+                    if update is None:
+                        continue
+                    if stale_update and catchup.stale_policy == "summarize":
+                        stale.append(update)
+                        continue
+                    await dispatcher.submit(update)
+                if catchup.progress is not None:
+                    catchup.progress(dict(stats))
+
+            await dispatcher.join()
+            if stale:
+                await catchup.summarize(stale,self._context)
+                stats["summarized"] = len(stale)
+                for update in stale:
+                    self._finished(update.update_id)
+                if catchup.progress is not None:
+                    catchup.progress(dict(stats))
+        finally:
+            fetch.cancel()
+            await asyncio.gather(fetch,return_exceptions = True)
+            await dispatcher.close()
+
+    async def _next_batch (self,fetch,dispatcher = None):
+        """
+        returns the batch of fetch, or None when the application is stopped first
+        """
+        batch = asyncio.ensure_future(fetch if dispatcher is None else dispatcher.wait(fetch))
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        try:
+            await asyncio.wait((batch,stopping),return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            stopping.cancel()
+        if batch.done():
+            return batch.result()
+        batch.cancel()
+        fetch.cancel()
+        await asyncio.gather(batch,fetch,return_exceptions = True)
+        return None
+
+    def stop (self):
+        """
+        Stops the application gracefully: no more updates are fetched, the updates already received are processed
+        for up to `drain_timeout` seconds, telegram is told which updates were processed, the offset store is
+        checkpointed and the connections are closed once the requests in flight complete. Calling stop again
+        while the application drains stops processing right away.
+        run stops the application this way on SIGINT and SIGTERM.
+        """
+        if self._stopping is None:
+            return
+        if self._stopping.is_set():
+            self._expire_drain()
+            return
+        self._stopping.set()
+        self._drain_deadline = asyncio.get_running_loop().call_later(self.drain_timeout,self._expire_drain)
+
+    def _expire_drain (self):
+        if self._task is not None and not self._task.done():
+            self._drain_expired = True
+            self._task.cancel()
+
+    async def _confirm (self):
+        """
+        confirm to telegram the updates processed before stopping
+        """
+        if self._offset is None:
+            return
+        url = self._context.url.add_method("getUpdates")
+        try:
+            await self._context._poll(url = url,params = {"offset":self.offset,"limit":1,"timeout":0})
+        except Exception:
+            # updates not confirmed are received again on the next start
+            pass
+
+    async def _runner (self,callback,wait_for,timeout = 30):
+
+        self._callback = callback
+        self._stopping = asyncio.Event()
+        self._progress = asyncio.Event()
+        self._drain_expired = False
+        self._task = asyncio.current_task()
+        store = self._context.offset_store
+        if self._offset is None and store is not None and store.update_id is not None:
+            self._offset = store.update_id + 1
+
+        dispatcher = None
+        if self.concurrency:
+            async def process (update):
+                await self._process(update,callback)
+            dispatcher = Dispatcher(process,self.concurrency,self.queue_size)
+            dispatcher.start()
+
+        fetch = None
+        try:
+            if self.catchup is not None:
+                await self._catch_up(callback)
+            if not self._stopping.is_set():
+                fetch = asyncio.ensure_future(self._fetch(timeout,wait_for))
+            while fetch is not None:
+                batch = await self._next_batch(fetch,dispatcher)
+                if batch is None:
+                    break
+                updates = batch[1]
+                self._received_batch(updates)
+                # prefetch the next batch while this one is processed
+                fetch = None
+                if not self._stopping.is_set():
+                    fetch = asyncio.ensure_future(self._fetch(timeout,wait_for))
 
                 for update in updates:
-                    await self._process_update(update,callback)
+                    update = await self._parse(update)
+                    if update is None:
+                        continue
+                    if dispatcher is None:
+                        await self._process(update,callback)
+                    else:
+                        await dispatcher.submit(update)
 
-                await asyncio.sleep(wait_for)
-                continue
+            # stopped, drain the updates received
+            if dispatcher is not None:
+                await dispatcher.join()
+            await self._confirm()
+
+        except asyncio.CancelledError:
+            if not self._drain_expired:
+                raise
+            await self._confirm()
 
         except Exception as exp:
+            if not await self._handle_error(exp):
+                raise
+
+        finally:
+            if fetch is not None:
+                fetch.cancel()
+                await asyncio.gather(fetch,return_exceptions = True)
+            if dispatcher is not None:
+                await dispatcher.close()
+            if self._drain_deadline is not None:
+                self._drain_deadline.cancel()
+                self._drain_deadline = None
+            if store is not None:
+                store.flush()
+            self._stopping = None
+            self._task = None
 
-            exp_type = type(exp)
+    async def _serve (self,callback,wait_for,timeout):
+        """
+        run the application until it is stopped, then close the context
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT,signal.SIGTERM):
             try:
-                handler = self._errorhandlers[exp_type]
-            except KeyError:
-                raise exp
-            else:
-                handler(exp)
+                loop.add_signal_handler(signum,self.stop)
+            except (NotImplementedError,RuntimeError):
+                # signal handlers are not supported on this platform or outside the main thread
+                pass
+        async with self._context:
+            await self._runner(callback,wait_for,timeout)
 
-    def run (self,callback,wait_for = 0):
+    def run (self,callback = None,wait_for = 0,timeout = 30):
         """
-        Runs the bot application, calling the `callback` coroutine for every request made to the bot API.
-        It waits for `wait_for` seconds before making another request to get updates, defualt is 0.
+        Runs the bot application, calling the `callback` coroutine for every update received from the bot API.
+        Updates are long polled, a getUpdates request waits up to `timeout` seconds for new updates.
         Args:
-            callback (async function): coroutine function to be called for every update object received. This function should
-            accept two arguments which are the update object and the bot context
+            callback (async function): coroutine function to be called for every update object received that no command or
+            update handler processes. This function should accept two arguments which are the update object and the bot context.
+            Without a callback, only the update types of the registered handlers are requested from telegram
+
+            wait_for (int): integer representing the time in seconds to wait before requesting for updates, default is 0
 
-            wait_for (int): integer representing the time in seconds to wait before requesting for updates
+            timeout (int): long polling timeout in seconds, default is 30. 0 falls back to short polling, which should only
+            be used for testing
 
+        The application runs until it is stopped, see stop, the context is then closed.
         """        
-        asyncio.run(self._runner(callback,wait_for))
+        asyncio.run(self._serve(callback,wait_for,timeout))
+
+    def run_multiprocess (self,callback = None,processes = None,context_factory = None,timeout = 30):
+        """
+        Runs the bot application on several processes. This process polls the updates and hands them to
+        `processes` worker processes running the handlers, updates of one chat always go to the same worker.
+        The getUpdates offset only advances past updates the workers finished processing. See ProcessPoller.
+        Args:
+            callback (async function): coroutine function to be called for every update object received. It should be
+            defined at the top level of a module, as it may be pickled to be sent to the workers
+
+            processes (int): number of worker processes, defaults to the number of CPUs
+
+            context_factory (callable): Optional. called in every worker to build its context, defaults to a context with
+            the token, base_url and local_mode of the context of the application
+
+            timeout (int): long polling timeout in seconds, default is 30
+        """
+        poller = ProcessPoller(self,callback,processes or os.cpu_count(),context_factory,timeout)
+
+        async def serve ():
+            async with self._context:
+                await poller.run()
+
+        asyncio.run(serve())
 
 
 class WebhookApp (BaseApp):
     """
     Implementation of the webhook update method of the bot application.
     The webhook app is implemented as an ASGI application and can be run with any
-    ASGI compliant server such as Daphne, Uvicorn or Hypercorn.
+    ASGI compliant server such as Daphne, Uvicorn or Hypercorn. Register the webhook with `set_webhook`.
 
-    The constructor takes in two arguments:
     Parameters:
         context (Context): The bot context
-        callback (Async function): A callback async function to call for every new update received
+        callback (Async function): A callback async function to call for every new update received that no command or update
+            handler processes. Without a callback, only the update types of the registered handlers are requested from telegram
+        stale_filter (StaleFilter): Optional. filter dropping or rerouting stale updates before they are processed
+        concurrency (int): Optional. number of updates processed concurrently in the background.
+        queue_size (int): maximum number of updates waiting on each worker. Defaults to 100.
+        overflow (str): "wait", "drop" or "reject", what happens to an update whose queue is full. Defaults to "wait".
+        secret_token (str): Optional. token telegram sends in the X-Telegram-Bot-Api-Secret-Token header, it is
+            also taken from set_webhook.
+        max_body_size (int): largest request body accepted, in bytes. Defaults to 1 MiB.
+    Raises:
+        ValueError: unknown overflow
     """
 
-    def __init__ (self,context,callback):
-        
-        super(WebhookApp,self).__init__(context)
+    def __init__ (self,context,callback = None,*,stale_filter:StaleFilter = None,concurrency = None,queue_size = 100,overflow = "wait",
+                  secret_token:str = None,max_body_size = 1024 * 1024):
+
+        if overflow not in _overflow_policies:
+            raise ValueError(f"unknown overflow {overflow}, pick one of {', '.join(_overflow_policies)}")
+        super(WebhookApp,self).__init__(context,stale_filter = stale_filter)
         self._callback = callback
+        self._webhook = None
+        self._webhook_changed = False
+        self._webhook_task = None
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self._dispatcher = None
+        self.dropped = 0
+        self.rejected = 0
 
-    async def __call__ (self,scope,recv,send):
-        request = Request(scope,recv)
-        update = await request.json()
+    async def set_webhook (self,url:str,**kwargs):
+        """
+        Registers the url of the application as the bot webhook, with the allowed updates of the registered handlers.
+        It is registered again whenever handlers are added or removed.
+        Args:
+            url (str): HTTPS URL telegram sends the updates to
+            kwargs: other parameters of Context.set_webhook, such as secret_token or max_connections
+        """
+        self._webhook = dict(kwargs,url = url)
+        if kwargs.get("secret_token") is not None:
+            self.secret_token = kwargs["secret_token"]
+        await self._register_webhook()
 
+    async def _register_webhook (self):
+        allowed_updates = self.allowed_updates
+        await self._context.set_webhook(**self._webhook,allowed_updates = allowed_updates)
+        if allowed_updates == self.allowed_updates:
+            self._webhook_changed = False
+
+    def _handlers_changed (self):
+        if self._webhook is None:
+            return
+        self._webhook_changed = True
         try:
-            await self._process_update(update,self._callback)
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # registered again on the next request
+            return
+        self._reregister()
+
+    def _reregister (self):
+        """
+        register the webhook again in a task, unless a registration is already running. A failed
+        registration is reported and made again on the next request
+        """
+        if self._webhook_task is not None and not self._webhook_task.done():
+            return
+        self._webhook_task = asyncio.get_running_loop().create_task(self._register_webhook())
+        self._webhook_task.add_done_callback(self._registered)
+
+    @staticmethod
+    def _registered (task):
+        if not task.cancelled() and task.exception() is not None:
+            task.get_loop().call_exception_handler({
+                "message":"failed to register the webhook",
+                "exception":task.exception(),
+                "task":task,
+            })
+
+    async def _process (self,update):
+        await self._safe_process(update,self._callback)
+
+    async def _enqueue (self,update) -> int:
+        """
+        queue update on the dispatcher, returns the status code of the response
+        """
+        if self._dispatcher is None:
+            self._dispatcher = Dispatcher(self._process,self.concurrency,self.queue_size)
+            self._dispatcher.start()
+        if self._dispatcher.try_submit(update):
+            return 200
+        if self.overflow == "wait":
+            await self._dispatcher.submit(update)
+            return 200
+        if self.overflow == "drop":
+            self.dropped += 1
+            return 200
+        self.rejected += 1
+        return 503
+
+    async def close (self):
+        """
+        process the updates still queued and stop the workers. It is called on the ASGI lifespan shutdown event
+        """
+        if self._dispatcher is not None:
+            await self._dispatcher.join()
+            await self._dispatcher.close()
+            self._dispatcher = None
+
+    def stats (self) -> dict:
+        """
+        Returns the statistics of the background processing.
+        Returns:
+            dict: the statistics of the dispatcher, see Dispatcher.stats, with the keys
+                dropped: number of updates dropped on overflow
+                rejected: number of requests rejected on overflow
+        """
+        stats = self._dispatcher.stats() if self._dispatcher is not None else {"queued":[],"processed":0,"errors":0}
+        stats.update(dropped = self.dropped,rejected = self.rejected)
+        return stats
+
+    async def _lifespan (self,recv,send):
+        while True:
+            message = await recv()
+            if message["type"] == "lifespan.startup":
+                await send({"type":"lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type":"lifespan.shutdown.complete"})
+                return
 
+    @staticmethod
+    def _header (scope,name:bytes) -> bytes|None:
+        for key,value in scope.get("headers",()):
+            if key == name:
+                return value
+        return None
+
+    def _authorized (self,scope) -> bool:
+        """
+        returns True if the request carries the secret token, or if there is none
+        """
+        if self.secret_token is None:
+            return True
+        token = self._header(scope,b"x-telegram-bot-api-secret-token")
+        return token is not None and hmac.compare_digest(token,self.secret_token.encode())
+
+    async def _read_body (self,scope,recv) -> bytearray|None:
+        """
+        receive the request body into a buffer allocated from its content-length, returns None if
+        the body is larger than max_body_size
+        """
+        length = self._header(scope,b"content-length")
+        length = int(length) if length is not None and length.isdigit() else 0
+        if length > self.max_body_size:
+            return None
+        body = bytearray(length)
+        size = 0
+        while True:
+            message = await recv()
+            chunk = message.get("body",b"")
+            if size + len(chunk) > self.max_body_size:
+                return None
+            # fills the buffer in place, and grows it past a missing or wrong content-length
+            body[size:size + len(chunk)] = chunk
+            size += len(chunk)
+            if not message.get("more_body",False):
+                break
+        del body[size:]
+        return body
+
+    async def _respond (self,send,status,body = b""):
+        headers = [(b"content-length",str(len(body)).encode())]
+        if body:
+            headers.append((b"content-type",b"application/json"))
+        await send({"type":"http.response.start","status":status,"headers":headers})
+        await send({"type":"http.response.body","body":body})
+
+    async def _reply (self,call:DeferredCall) -> bytes:
+        """
+        returns the body of the webhook response carrying call, or sends call and returns an empty body
+        if it uploads files, which a response can't carry
+        """
+        context = self._context
+        if context._attach_files(call.body)[1]:
+            await context.send_deferred(call)
+            return b""
+        if context.rate_limiter and context.rate_limiter.limits(call.method):
+            await context.rate_limiter.acquire(call.body.get("chat_id"))
+        return context.codec.dumps({"method":call.method,**context._compose_body(call.body)})
+
+    async def __call__ (self,scope,recv,send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(recv,send)
+            return
+        if scope["type"] != "http":
+            return
+        if self._webhook_changed:
+            self._reregister()
+        if scope["method"] != "POST":
+            await self._respond(send,405)
+            return
+        if not self._authorized(scope):
+            await self._respond(send,403)
+            return
+        data = await self._read_body(scope,recv)
+        if data is None:
+            await self._respond(send,413)
+            return
+        try:
+            update = self._context.codec.loads(data)
+        except ValueError:
+            update = None
+        if not isinstance(update,dict) or "update_id" not in update:
+            await self._respond(send,400)
+            return
+        if self.stale_filter is not None and not await self.stale_filter.filter([update],self._context,self._report_error):
+            await self._respond(send,200)
+            return
+        try:
+            update = self._context.parser.parse(update)
         except Exception as exp:
-            exp_type = type(exp)
-            try:
-                handler = self._errorhandlers[exp_type]
-            except KeyError:
-                raise exp
-            else:
-                handler(exp)
+            # telegram would send it again for nothing
+            await self._report_error(exp,update["update_id"])
+            await self._respond(send,200)
+            return
+
+        body = b""
+        if self.concurrency:
+            status = await self._enqueue(update)
+        else:
+            status = 200
+            call = await self._safe_process(update,self._callback,reply = True)
+            if call is not None:
+                try:
+                    body = await self._reply(call)
+                except Exception as exp:
+                    await self._report_error(exp,update.update_id)
+        await self._respond(send,status,body)
@@ -0,0 +1,57 @@
+"""
+This module contains the catch-up settings of the polling application, used to drain the updates
+queued on the bot API server while the bot was down
+"""
+from time import time
+
+__all__ = ("CatchUp",)
+
+_policies = ("process","drop","summarize")
+
+
+class CatchUp:
+    """
+    Settings of the catch-up phase a PollingApp goes through when it starts. Until the queue of pending
+    updates is empty, updates are short polled in batches of 100 and processed on `concurrency` worker
+    tasks, keeping the updates of every chat in order. The application then switches to long polling.
+
+    Updates older than `stale_after` seconds are handled according to `stale_policy`:
+
+    - "process": processed like any other update
+    - "drop": skipped
+    - "summarize": skipped, and once the backlog is drained the `summarize` coroutine function is called
+      with the list of the skipped updates and the context, for example to tell users what was missed.
+      The offset store only moves past them once summarize returned.
+
+    Only messages, chat member updates and callback queries on a message carry a date, other updates are never stale.
+    Staleness is checked on the raw update, so dropped updates are never parsed.
+
+    Args:
+        concurrency (int): number of updates processed concurrently. Defaults to 32.
+        stale_after (int | float): Optional. age in seconds past which an update is stale. Updates are never stale when not given.
+        stale_policy (str): "process", "drop" or "summarize". Defaults to "process".
+        summarize (async function): coroutine function called with the stale updates and the context, required by the "summarize" policy.
+        progress (function): Optional. called after every batch with a dict of the progress of the catch-up, with the keys
+            batches, received, processed, stale, dropped and summarized.
+    Raises:
+        ValueError: unknown stale_policy, or summarize missing for the "summarize" policy
+    """
+
+    def __init__ (self,concurrency = 32,stale_after = None,stale_policy = "process",summarize = None,progress = None):
+        if stale_policy not in _policies:
+            raise ValueError(f"unknown stale policy {stale_policy}, pick one of {', '.join(_policies)}")
+        if stale_policy == "summarize" and summarize is None:
+            raise ValueError("the summarize stale policy requires a summarize coroutine function")
+        self.concurrency = concurrency
+        self.stale_after = stale_after
+        self.stale_policy = stale_policy
+        self.summarize = summarize
+        self.progress = progress
+
+    def is_stale (self,date,now = None) -> bool:
+        """
+        returns True if an update sent at the unix time `date` is stale
+        """
+        if self.stale_after is None or date is None:
+            return False
+        return (now if now is not None else time()) - date > self.stale_after
@@ -8,20 +8,51 @@ from autotelegram.telegram.inline.api import InlineAPI
 from autotelegram.telegram.passport.api import PassportAPI
 from autotelegram.telegram.payments.api import PaymentsAPI
 from autotelegram.telegram.stickers.api import StickerAPI
+from autotelegram.network.codec import get_codec
 from autotelegram.network.connection import HTTPConnection
+from autotelegram.network.protocol import TransportError
 from autotelegram.network.urlmanager import UrlManager
+from autotelegram.telegram.objects import BaseObject,InputFile
 from autotelegram.telegram.parser import Parser,Composer
-import json
+from autotelegram.telegram.errors import TelegramResultError
+from autotelegram.telegram.ratelimiter import RateLimiter
+from time import monotonic
+import asyncio
+import contextlib
+import contextvars
+import mmap
+import os
+import shutil
 
-class TelegramResultError(Exception):
+
+class DeferredCall:
     """
-    raised when telegram returns "ok" as false
+    A bot API call captured by Context.defer instead of being sent. A WebhookApp handler returns it to have it
+    carried by the response to the webhook request, saving the round trip of a request.
+    Args:
+        method (str): name of the bot API method, such as "sendMessage"
+        body (dict): parameters of the call
     """
-    def __init__ (self,err_code,desc):
-        
-        self.err_code = err_code
-        self.desc = desc
-        super().__init__(f"Error Code <{err_code}>:: {desc}")
+
+    def __init__ (self,method,body):
+        self.method = method
+        self.body = body
+
+
+class _CallDeferred(Exception):
+    """
+    raised by _post while a call is deferred, carrying the call
+    """
+
+    def __init__ (self,call):
+        self.call = call
+
+
+# set while Context.defer runs a call
+_deferring = contextvars.ContextVar("_deferring",default = False)
+
+# retry deadline of the calls made in a Context.deadline scope
+_deadline = contextvars.ContextVar("_deadline",default = None)
 
 
 class Context(
@@ -38,48 +69,567 @@ class Context(
 
     def __init__ (self,
         token,*,
+        base_url = "https://api.telegram.org",
+        local_mode = False,
+        uds = None,
+        codec = None,
         connection = None,
+        poll_connection = None,
+        poll_timeout_margin = 5,
+        rate_limit = True,
+        rate_limiter = None,
+        retry_policy = None,
+        file_cache = None,
+        media_fetcher = None,
+        offset_store = None,
         offset_autoincrement = True
     ):
         """
         Context acts as the representation of the telegram bot
+
+        Args:
+            token (str): the bot token
+            base_url (str): url of the bot API server. Pass the address of a self hosted bot API server to use it instead of telegram's.
+            local_mode (bool): the bot API server runs on this host in `--local` mode. Files returned by getFile
+                are then read from their local path instead of being downloaded.
+            uds (str): path of the Unix domain socket of a bot API server running on this host, used by both default
+                connections. When only `connection` is passed and it connects through a socket, the default
+                poll connection uses the same socket.
+            codec (JSONCodec | str): JSON codec, or the name of one, used to decode responses and encode the
+                request bodies of the default connections. Defaults to the fastest codec installed. Telegram objects in request
+                bodies are encoded with the composer.
+            connection (HTTP): connection used for every request except getUpdates. Defaults to a pooled HTTPConnection.
+            poll_connection (HTTP): connection reserved for getUpdates long polls, kept apart from the
+                outbound request pool. Defaults to a single connection HTTPConnection.
+            poll_timeout_margin (int | float): seconds added to the long poll `timeout` to get the read timeout of a poll request.
+            rate_limit (bool): hold back outgoing messages to stay within the telegram flood limits. Defaults to True.
+            rate_limiter (RateLimiter): limiter used when `rate_limit` is True. Defaults to a RateLimiter with the telegram limits.
+            retry_policy (RetryPolicy): policy for repeating requests that failed on flood control, server or
+                transport errors. Failed requests are not repeated when not given.
+            file_cache (FileIdCache): cache of the file_ids of uploaded files. Files found in it are sent by
+                file_id instead of being uploaded again, and a file sent by several requests at once is uploaded
+                by the first one only. Uploads are not cached when not given.
+            media_fetcher (MediaFetcher): download service used by fetch_media and read_media.
+            offset_store (OffsetStore): store of the highest processed update_id. Polling resumes after the
+                update_id it holds, and the polling applications commit the updates they processed to it.
+            offset_autoincrement (bool): confirm received updates automatically on the next get_updates call.
         """
         self.offset_autoincrement = offset_autoincrement
         self._latest_update = 0
-        self.url = UrlManager(token)
-        self.connection = connection if connection else HTTPConnection()
+        self.url = UrlManager(token,base_url)
+        self.local_mode = local_mode
+        if codec is None or isinstance(codec,str):
+            codec = get_codec(codec,default = self.composer.compose)
+        self.codec = codec
+        if uds is None:
+            uds = getattr(connection,"uds",None)
+        self.connection = connection if connection else HTTPConnection(codec = codec,uds = uds)
+        self.poll_connection = poll_connection if poll_connection else HTTPConnection(
+            max_connections = 1,
+            max_keepalive_connections = 1,
+            codec = codec,
+            uds = uds
+        )
+        self.poll_timeout_margin = poll_timeout_margin
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self.retry_policy = retry_policy
+        self.file_cache = file_cache
+        self._uploads = {}
+        self.media_fetcher = media_fetcher
+        self.offset_store = offset_store
+        self._requests_in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        if offset_store is not None and (update_id := offset_store.load()) is not None:
+            self._latest_update = update_id
         self._set_current_context()
 
-    async def _get (self,*,url = None,headers = None):
+    async def _get (self,*,url = None,headers = None,deadline = None):
         """
         The _get method adds error handling on top of the abstract get method provided by
         the get method from the HTTPConnection object. If the return value is a success, that is
         it has "ok" as True, then it returns the json string. If "ok" is False, it extracts the 
         description of the failure and raises an error with the description
         """
-        res = await self.connection.get(url,headers)
-        return self._error_handler(res)
+        self._begin_request()
+        try:
+            return await self._request(self.connection.get,(url,headers),deadline)
+        finally:
+            self._end_request()
 
-    async def _post (self,*,url = None,headers = None,body = None):
+    async def _post (self,*,url = None,headers = None,body = None,deadline = None):
         """
         The _post method adds error handling on top of the abstract get method provided by
         the get method from the HTTPConnection object. If the return value is a success, that is
         it has "ok" as True, then it returns the json string. If "ok" is False, it extracts the 
-        description of the failure and raises an error with the description
+        description of the failure and raises an error with the description.
+        Requests sending messages wait on the rate limiter first.
+        Bodies holding InputFile objects are uploaded as multipart/form-data. Telegram objects in the body are
+        composed to dicts first, so any connection and codec can encode it.
+        While a call is deferred, see defer, the request is captured instead of being sent.
+        """
+        if _deferring.get():
+            raise _CallDeferred(DeferredCall(url.rpartition("/")[2],body or {}))
+        self._begin_request()
+        try:
+            if self.rate_limiter and self.rate_limiter.limits(url.rpartition("/")[2]):
+                await self.rate_limiter.acquire(body.get("chat_id") if body else None)
+            files = None
+            uncached = []
+            if body:
+                if self.file_cache is not None:
+                    body,uncached = await self._cached_files(body)
+                body,files = self._attach_files(body)
+            if not files:
+                return await self._request(self.connection.post,(url,headers,self._compose_body(body)),deadline)
+
+            retry = all(file.replayable for file in files.values())
+            res = await self._request(self.connection.post,(url,headers,body,files),deadline,retry)
+            for param,keys in uncached:
+                file_id = self._sent_file_id(res,param)
+                if file_id is not None:
+                    self.file_cache.put(keys,file_id)
+                    self._uploads.pop(keys[-1]).set_result(file_id)
+            return res
+        finally:
+            # the requests waiting on an upload that failed upload the file themselves
+            for param,keys in uncached:
+                upload = self._uploads.pop(keys[-1],None)
+                if upload is not None:
+                    upload.set_result(None)
+            self._end_request()
+
+    async def defer (self,call) -> DeferredCall:
+        """
+        Returns the request the coroutine `call` of a bot API method would send, without sending it. A WebhookApp
+        handler returns it to reply in the response to the webhook request:
+        `return await context.defer(context.send_message(chat_id = chat_id,text = "hi"))`
+        Raises:
+            ValueError: call sends no request that can be deferred, such as the get requests of get_me
+        """
+        token = _deferring.set(True)
+        try:
+            await call
+        except _CallDeferred as deferred:
+            return deferred.call
+        finally:
+            _deferring.reset(token)
+        raise ValueError("the call sends no request that can be deferred")
+
+    async def send_deferred (self,call:DeferredCall):
+        """
+        send a deferred call as a request, returns its result
+        """
+        return await self._post(url = self.url.add_method(call.method),body = call.body)
+
+    @contextlib.contextmanager
+    def deadline (self,seconds):
         """
-        res = await self.connection.post(url,headers,body)
+        Scope in which the calls made stop being retried once they would end after `seconds`, counted from the
+        start of each call, instead of after the deadline of the retry policy:
+        `with context.deadline(5): await context.send_message(chat_id = chat_id,text = "hi")`
+        Args:
+            seconds (int | float): retry deadline of each call made in the scope
+        """
+        token = _deadline.set(seconds)
+        try:
+            yield
+        finally:
+            _deadline.reset(token)
+
+    def _begin_request (self):
+        self._requests_in_flight += 1
+        self._idle.clear()
+
+    def _end_request (self):
+        self._requests_in_flight -= 1
+        if not self._requests_in_flight:
+            self._idle.set()
+
+    async def aclose (self,timeout = None):
+        """
+        Closes the context: waits up to `timeout` seconds for the requests in flight, such as messages being sent
+        by handlers, to complete, then checkpoints and closes the offset store and the file cache, and closes the
+        connections. Named aclose since `close` is the bot API method.
+        Args:
+            timeout (int | float): Optional. maximum seconds to wait for requests in flight, they are waited for without limit when not given.
+        """
+        if self._requests_in_flight:
+            try:
+                await asyncio.wait_for(self._idle.wait(),timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.offset_store is not None:
+            self.offset_store.close()
+        if self.file_cache is not None:
+            self.file_cache.close()
+        await self.connection.close()
+        await self.poll_connection.close()
+
+    async def __aenter__ (self):
+        return self
+
+    async def __aexit__ (self,*exc_info):
+        await self.aclose()
+
+    async def _cached_files (self,body):
+        """
+        Replaces the InputFile parameters of a body found in the file cache by their file_id. A file being
+        uploaded by another request is waited for and sent by the file_id of that upload, or uploaded again
+        if it failed.
+        Returns:
+            tuple: the body and a list of (parameter,keys) of the files to cache once uploaded
+        """
+        uncached = []
+        try:
+            for param,value in body.items():
+                if not isinstance(value,InputFile):
+                    continue
+                keys = await self.file_cache.keys(param,value)
+                if keys is None:
+                    continue
+                file_id = self.file_cache.get(keys)
+                while file_id is None and keys[-1] in self._uploads:
+                    file_id = await asyncio.shield(self._uploads[keys[-1]])
+                if file_id is None:
+                    self._uploads[keys[-1]] = asyncio.get_running_loop().create_future()
+                    uncached.append((param,keys))
+                else:
+                    body = {**body,param:file_id}
+        except BaseException:
+            for param,keys in uncached:
+                self._uploads.pop(keys[-1]).set_result(None)
+            raise
+        return body,uncached
+
+    @staticmethod
+    def _sent_file_id (res,param):
+        """
+        returns the file_id of the file uploaded as `param` from the message returned by telegram
+        """
+        try:
+            media = res[param]
+        except (KeyError,TypeError):
+            return None
+        if isinstance(media,list):
+            # photos are returned in all their sizes, the largest one being last
+            media = media[-1] if media else {}
+        return media.get("file_id")
+
+    def _compose_body (self,value):
+        """
+        returns value with the telegram objects it holds composed to dicts
+        """
+        if isinstance(value,BaseObject):
+            return self.composer.compose(value)
+        if isinstance(value,list):
+            return [self._compose_body(v) for v in value]
+        if isinstance(value,dict):
+            return {k:self._compose_body(v) for k,v in value.items()}
+        return value
+
+    def _attach_files (self,body):
+        """
+        Takes the InputFile objects out of a request body. Files passed directly as a parameter are
+        sent under the parameter name, files nested in other objects such as InputMedia are sent
+        under a generated name and replaced by an "attach://<name>" reference.
+        Returns:
+            tuple: the body and a dict of the files to upload, None if there are none
+        """
+        files = {}
+
+        def attach (value):
+            if isinstance(value,InputFile):
+                name = f"file{len(files)}"
+                files[name] = value
+                return "attach://" + name
+            if isinstance(value,list):
+                return [attach(v) for v in value]
+            if isinstance(value,dict):
+                return {k:attach(v) for k,v in value.items()}
+            if isinstance(value,BaseObject):
+                return {("from" if k == "from_" else k):attach(v) for k,v in vars(value).items()
+                        if v is not None and not k.startswith("_")}
+            return value
+
+        fields = {}
+        for key,value in body.items():
+            if isinstance(value,InputFile):
+                files[key] = value
+            elif isinstance(value,(list,dict,BaseObject)):
+                fields[key] = attach(value)
+            else:
+                fields[key] = value
+        if not files:
+            return body,None
+        return fields,files
+
+    async def _request (self,method,args,deadline = None,retry = True):
+        """
+        Calls the connection `method` with `args` and handles the response. When a retry policy
+        is set and `retry` is True, failed requests are repeated as the policy decides for as long
+        as the retries end before `deadline` seconds, which defaults to the deadline of the enclosing
+        deadline scope, else of the policy.
+        """
+        policy = self.retry_policy
+        if policy is None or not retry:
+            return self._error_handler(await method(*args))
+
+        if deadline is None:
+            deadline = _deadline.get()
+        ends = monotonic() + (deadline if deadline is not None else policy.deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._error_handler(await method(*args))
+            except (TelegramResultError,TransportError) as exp:
+                delay = policy.delay(exp,attempt)
+                if delay is None or monotonic() + delay > ends:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def _poll (self,*,url = None,params = None):
+        """
+        The _poll method makes getUpdates requests on the poll connection, so that long polls
+        never hold a connection of the outbound request pool. The read timeout of the request is
+        sized to the long poll `timeout` plus `poll_timeout_margin`.
+        """
+        poll_timeout = float(params.get("timeout",0)) if params else 0
+        if params:
+            # list parameters such as allowed_updates are sent JSON-serialized
+            params = {name:self.codec.dumps(value).decode() if isinstance(value,(list,dict)) else value for name,value in params.items()}
+        res = await self.poll_connection.get(url,params,poll_timeout + self.poll_timeout_margin)
         return self._error_handler(res)
 
     def _error_handler(self,res):
         """
         This function does the actual error handling used in _get and _post
         """
-        res = json.loads(res)
+        try:
+            res = self.codec.loads(res)
+        except ValueError as exp:
+            raise TransportError("malformed response from the bot API") from exp
         if res["ok"]:
             return res["result"]
         error_code,desc = res["error_code"],res["description"]
-        raise TelegramResultError(error_code,desc)
+        parameters = res.get("parameters")
+        if parameters:
+            parameters = self.parser.parse(parameters,"response_parameters")
+        raise TelegramResultError(error_code,desc,parameters)
     
+    def _local_path (self,file):
+        """
+        returns the local path of `file` when it can be read from disk, else None
+        """
+        file_path = getattr(file,"file_path",file)
+        if self.local_mode and os.path.isabs(file_path):
+            return file_path
+        return None
+
+    async def read_file (self,file):
+        """
+        Returns the contents of a file returned by get_file. In local mode the file is memory mapped
+        from the path given by the bot API server, so no copy of it is made. Otherwise it is downloaded
+        from the bot API server.
+        Args:
+            file (File | str): the File object or its `file_path`
+        Returns:
+            mmap.mmap | bytes: the contents of the file. A memory map should be closed once done with.
+        """
+        path = self._local_path(file)
+        if path is None:
+            async with self.connection.stream(self.url.file_url(getattr(file,"file_path",file))) as response:
+                await self._check_download(response)
+                return await response.aread()
+
+        with open(path,"rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(),0,access = mmap.ACCESS_READ)
+
+    async def save_file (self,file,destination):
+        """
+        Saves a file returned by get_file to `destination`. In local mode the file is copied on disk,
+        which uses the platform's in kernel copy where available. Otherwise it is downloaded from the
+        bot API server with download_file.
+        Args:
+            file (File | str): the File object or its `file_path`
+            destination (str | os.PathLike): path to save the file to
+        Returns:
+            str | os.PathLike: the destination path
+        """
+        path = self._local_path(file)
+        if path is None:
+            return await self.download_file(file,destination)
+        await asyncio.to_thread(shutil.copyfile,path,destination)
+        return destination
+
+    async def iter_file (self,file,chunk_size = 256 * 1024,offset = 0):
+        """
+        Async iterator over the contents of a file returned by get_file, in chunks of at most
+        `chunk_size` bytes. The download is streamed over the shared connection pool. In local mode
+        the file is read from disk.
+        Args:
+            file (File | str): the File object or its `file_path`
+            chunk_size (int): maximum size of a chunk. Defaults to 256 KiB.
+            offset (int): number of bytes to skip from the start of the file. Defaults to 0.
+        """
+        path = self._local_path(file)
+        if path is not None:
+            with open(path,"rb") as f:
+                f.seek(offset)
+                while chunk := await asyncio.to_thread(f.read,chunk_size):
+                    yield chunk
+            return
+
+        url = self.url.file_url(getattr(file,"file_path",file))
+        headers = {"range":f"bytes={offset}-"} if offset else None
+        async with self.connection.stream(url,headers) as response:
+            await self._check_download(response)
+            skip = offset if response.status_code == 200 else 0
+            async for chunk in response.aiter_bytes(chunk_size):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk,skip = chunk[skip:],0
+                yield chunk
+
+    async def download_file (self,file,destination,*,chunk_size = 256 * 1024,resume = True,parallel = 1,part_size = 8 * 1024 * 1024):
+        """
+        Downloads a file returned by get_file to `destination`, streaming it to disk in chunks over the
+        shared connection pool.
+
+        The file is written to `destination + ".part"` and renamed to `destination` once complete, so a file
+        already at `destination` is never taken for a partial download. A `.part` file left by an interrupted
+        download is resumed with a range request instead of being downloaded again, and when a retry policy is
+        set, downloads interrupted by transport errors are resumed from the last byte written. Files whose
+        `file_size` is known and larger than `part_size` can be fetched as `parallel` ranges at once.
+
+        Args:
+            file (File | str): the File object or its `file_path`
+            destination (str | os.PathLike): path to save the file to
+            chunk_size (int): maximum number of bytes read at once. Defaults to 256 KiB.
+            resume (bool): resume a partial download left at `destination + ".part"`. Defaults to True.
+            parallel (int): number of ranges fetched at once. Defaults to 1.
+            part_size (int): size of a range fetched in parallel. Defaults to 8 MiB.
+        Returns:
+            str | os.PathLike: the destination path
+        """
+        if self._local_path(file) is not None:
+            return await self.save_file(file,destination)
+
+        url = self.url.file_url(getattr(file,"file_path",file))
+        size = getattr(file,"file_size",None)
+        part = os.fspath(destination) + ".part"
+        start = 0
+        if resume and os.path.exists(part):
+            start = os.path.getsize(part)
+        if not start and parallel > 1 and size and size > part_size:
+            # the ranges are written out of order into a preallocated file, which can't be resumed
+            await asyncio.to_thread(self._truncate_file,part,size)
+            semaphore = asyncio.Semaphore(parallel)
+
+            async def fetch (first,last):
+                async with semaphore:
+                    await self._download_range(url,part,first,last,chunk_size)
+
+            tasks = [asyncio.ensure_future(fetch(first,min(first + part_size,size) - 1)) for first in range(0,size,part_size)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks,return_exceptions = True)
+                os.remove(part)
+                raise
+        else:
+            if not start:
+                await asyncio.to_thread(self._truncate_file,part,0)
+            if size is None or start < size:
+                await self._download_range(url,part,start,None,chunk_size)
+        os.replace(part,destination)
+        return destination
+
+    async def _download_range (self,url,destination,first,last,chunk_size):
+        """
+        Writes the bytes `first` to `last` of the file at `url` into `destination` at the same position,
+        `last` being None for the end of the file. Transport errors are retried from the last byte
+        written as the retry policy decides.
+        """
+        policy = self.retry_policy
+        deadline = _deadline.get()
+        ends = monotonic() + (deadline if deadline is not None else policy.deadline) if policy else None
+        attempt = 0
+        position = first
+        while True:
+            attempt += 1
+            try:
+                headers = None
+                if position or last is not None:
+                    headers = {"range":f"bytes={position}-" + ("" if last is None else str(last))}
+                async with self.connection.stream(url,headers) as response:
+                    if response.status_code == 416:
+                        return
+                    await self._check_download(response)
+                    if response.status_code == 200 and position:
+                        if last is not None:
+                            raise TransportError("the server does not support range requests")
+                        position = 0
+                    with open(destination,"r+b") as f:
+                        f.seek(position)
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            await asyncio.to_thread(f.write,chunk)
+                            position += len(chunk)
+                        if last is None:
+                            f.truncate()
+                return
+            except TransportError as exp:
+                delay = policy.delay(exp,attempt) if policy else None
+                if delay is None or monotonic() + delay > ends:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def _check_download (self,response):
+        """
+        raises the error returned by the bot API if a download failed
+        """
+        if response.status_code not in (200,206):
+            self._error_handler(await response.aread())
+            raise TransportError(f"download failed with status {response.status_code}")
+
+    async def fetch_media (self,media):
+        """
+        Returns the path of the downloaded file of an incoming media, such as `Message.photo` or
+        `Message.document`. Files are downloaded once into the cache of the media fetcher and shared
+        between all the handlers asking for them.
+        Args:
+            media (PhotoSize | list[PhotoSize] | Document | Video | Voice | Audio | Animation | VideoNote | Sticker): the media to fetch
+        Returns:
+            str: path of the cached file
+        Raises:
+            ValueError: the context has no media fetcher
+        """
+        if self.media_fetcher is None:
+            raise ValueError("fetch_media requires the context to be created with a media_fetcher")
+        return await self.media_fetcher.fetch(self,media)
+
+    async def read_media (self,media):
+        """
+        Returns the contents of the file of an incoming media, see fetch_media
+        """
+        if self.media_fetcher is None:
+            raise ValueError("read_media requires the context to be created with a media_fetcher")
+        return await self.media_fetcher.read(self,media)
+
+    @staticmethod
+    def _truncate_file (destination,size):
+        with open(destination,"wb") as f:
+            f.truncate(size)
+
     def _set_current_context (self):
         """
         This method sets the _current_context variable to self
@@ -0,0 +1,203 @@
+"""
+This module contains the dispatcher used by the applications to process updates concurrently,
+while keeping the updates of every chat in order
+"""
+import asyncio
+import zlib
+
+__all__ = ("Dispatcher","update_key","update_date","jump_hash")
+
+# updates sharded by the chat they happen in
+_chat_updates = (
+    "message","edited_message","channel_post","edited_channel_post",
+    "my_chat_member","chat_member","chat_join_request",
+)
+# updates sharded by the user who sent them, they don't belong to a chat
+_user_updates = (
+    "callback_query","inline_query","chosen_inline_result","shipping_query","pre_checkout_query",
+)
+
+
+def _get (obj,name):
+    if isinstance(obj,dict):
+        return obj.get(name)
+    return getattr(obj,name,None)
+
+
+def update_key (update):
+    """
+    Returns the key updates are sharded by: the chat id for messages and chat member updates, the user id for
+    callback queries, inline queries and payment queries, and the update_id for anything else.
+    Works on both Update objects and raw update dicts.
+    """
+    for name in _chat_updates:
+        value = _get(update,name)
+        if value is not None:
+            return _get(_get(value,"chat"),"id")
+    for name in _user_updates:
+        value = _get(update,name)
+        if value is not None:
+            user = value.get("from") if isinstance(value,dict) else _get(value,"from_")
+            return _get(user,"id")
+    poll_answer = _get(update,"poll_answer")
+    if poll_answer is not None:
+        return _get(_get(poll_answer,"user"),"id")
+    return _get(update,"update_id")
+
+
+def update_date (update) -> int|None:
+    """
+    Returns the unix time an update was sent at, for messages, chat member updates and callback queries
+    on a message, else None. Works on both Update objects and raw update dicts.
+    """
+    for name in _chat_updates:
+        value = _get(update,name)
+        if value is not None:
+            return _get(value,"date")
+    callback_query = _get(update,"callback_query")
+    if callback_query is not None:
+        return _get(_get(callback_query,"message"),"date")
+    return None
+
+
+def jump_hash (key,buckets:int) -> int:
+    """
+    Jump consistent hash of key over `buckets` buckets. The bucket of a key is stable across
+    processes and runs, and growing the number of buckets only moves the keys of the new buckets.
+    Keys that are not ints are hashed with crc32 first.
+    """
+    if not isinstance(key,int):
+        key = zlib.crc32(str(key).encode())
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket,jump = -1,0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class Dispatcher:
+    """
+    Processes updates on a fixed pool of worker tasks. Every worker owns a bounded queue and updates are
+    sharded over the workers by `update_key`, so the updates of one chat are always handled by the same
+    worker, strictly in the order they were submitted, while different chats proceed in parallel.
+
+    An exception raised by `process` doesn't stop the worker, the first one is kept and raised by the
+    next call to submit or wait.
+
+    Args:
+        process (async function): coroutine function called with every update
+        concurrency (int): number of worker tasks. Defaults to 8.
+        queue_size (int): maximum number of updates waiting on each worker, submit waits while the queue
+            of the update is full. Defaults to 100.
+    """
+
+    def __init__ (self,process,concurrency = 8,queue_size = 100):
+        self.process = process
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self._queues = []
+        self._workers = []
+        self._failure = None
+        self.processed = 0
+        self.errors = 0
+
+    def start (self):
+        """
+        start the worker tasks, it must be called from a running event loop
+        """
+        self._failure = asyncio.get_running_loop().create_future()
+        self._queues = [asyncio.Queue(self.queue_size) for _ in range(self.concurrency)]
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def _worker (self,queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.process(update)
+            except Exception as exp:
+                self.errors += 1
+                if not self._failure.done():
+                    self._failure.set_exception(exp)
+            finally:
+                self.processed += 1
+                queue.task_done()
+
+    def shard (self,update) -> int:
+        """
+        returns the index of the worker processing update
+        """
+        return jump_hash(update_key(update),self.concurrency)
+
+    async def submit (self,update):
+        """
+        Queues update on its worker, waiting while the queue is full.
+        Raises:
+            Exception: the first exception raised while processing an update
+        """
+        if not self._workers:
+            self.start()
+        await self.wait(self._queues[self.shard(update)].put(update))
+
+    def try_submit (self,update) -> bool:
+        """
+        Queues update on its worker if there is room, returns False if its queue is full.
+        Raises:
+            Exception: the first exception raised while processing an update
+        """
+        if not self._workers:
+            self.start()
+        if self._failure.done():
+            self._failure.result()
+        try:
+            self._queues[self.shard(update)].put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def wait (self,aw):
+        """
+        Returns the result of the awaitable aw, unless processing an update fails first,
+        in which case aw is cancelled and the exception is raised.
+        """
+        aw = asyncio.ensure_future(aw)
+        if self._failure is not None and not self._failure.done():
+            await asyncio.wait((aw,self._failure),return_when = asyncio.FIRST_COMPLETED)
+        if self._failure is not None and self._failure.done():
+            aw.cancel()
+            self._failure.result()
+        return await aw
+
+    async def join (self):
+        """
+        wait until every queued update was processed
+        """
+        await self.wait(asyncio.gather(*(queue.join() for queue in self._queues)))
+
+    async def close (self):
+        """
+        cancel the worker tasks, dropping the updates still queued
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers,return_exceptions = True)
+        self._workers = []
+        if self._failure is not None and self._failure.done():
+            # mark the exception as retrieved
+            self._failure.exception()
+
+    def stats (self) -> dict:
+        """
+        Returns the statistics of the dispatcher.
+        Returns:
+            dict: with the keys
+                queued: number of updates waiting on each worker
+                processed: number of updates processed
+                errors: number of updates whose processing raised an exception
+        """
+        return {
+            "queued":[queue.qsize() for queue in self._queues],
+            "processed":self.processed,
+            "errors":self.errors,
+        }
@@ -0,0 +1,25 @@
+"""
+This module contains the errors raised by the bot API
+"""
+
+__all__ = ("TelegramResultError",)
+
+
+class TelegramResultError(Exception):
+    """
+    raised when telegram returns "ok" as false. `parameters` holds the ResponseParameters
+    returned with the error, if any
+    """
+    def __init__ (self,err_code,desc,parameters = None):
+        
+        self.err_code = err_code
+        self.desc = desc
+        self.parameters = parameters
+        super().__init__(f"Error Code <{err_code}>:: {desc}")
+
+    @property
+    def retry_after (self):
+        """
+        seconds to wait before repeating the request when flood control was exceeded, else None
+        """
+        return self.parameters.retry_after if self.parameters else None
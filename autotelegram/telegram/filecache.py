@@ -0,0 +1,136 @@
+"""
+This module contains the file_id cache used by the context to avoid uploading the same
+file more than once
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from time import time
+
+__all__ = ("FileIdCache",)
+
+
+class FileIdCache:
+    """
+    Cache of the file_ids telegram returns for uploaded files, keyed by the content hash of the file.
+    When a context has a file cache, every InputFile passed directly as a parameter, such as the `photo`
+    of send_photo, is looked up before being uploaded and replaced by its file_id when it was sent before.
+    Files read from async iterators are never cached since they can't be hashed without consuming them.
+
+    Keys include the parameter name, since a file_id can only be reused for the same kind of media.
+    The cache is a size bounded LRU, which can be backed by an sqlite database so it survives restarts.
+
+    Args:
+        max_entries (int): maximum number of file_ids kept. The least recently used are evicted first. Defaults to 10000.
+        path (str | os.PathLike): Optional. sqlite database to persist the cache to.
+        track_paths (bool): also key files read from disk by their path, modification time and size, so a
+            file that didn't change is not hashed again. Defaults to True.
+    """
+
+    def __init__ (self,max_entries = 10000,path = None,track_paths = True):
+        self.max_entries = max_entries
+        self.track_paths = track_paths
+        self._entries = OrderedDict()
+        self._db = None
+        self._inserts = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, used REAL NOT NULL)")
+            self._db.commit()
+
+    async def keys (self,param:str,file) -> list[str]|None:
+        """
+        Returns the cache keys of an InputFile sent as `param`, the cheapest key first,
+        or None if the file can't be cached
+        """
+        source = file.file
+        if isinstance(source,(str,os.PathLike)):
+            keys = []
+            if self.track_paths:
+                stat = os.stat(source)
+                keys.append(f"{param}:path:{os.path.abspath(source)}:{stat.st_mtime_ns}:{stat.st_size}")
+                found = self._lookup(keys[0])
+                if found is not None:
+                    return keys
+            digest = await asyncio.to_thread(self._hash_path,source)
+        elif isinstance(source,(bytes,bytearray,memoryview)):
+            keys = []
+            digest = hashlib.sha256(source).hexdigest()
+        else:
+            return None
+        keys.append(f"{param}:sha256:{digest}")
+        return keys
+
+    @staticmethod
+    def _hash_path (path) -> str:
+        sha = hashlib.sha256()
+        with open(path,"rb") as f:
+            while chunk := f.read(1024 * 1024):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def get (self,keys:list[str]) -> str|None:
+        """
+        Returns the file_id cached under any of `keys`, else None
+        """
+        for key in keys:
+            file_id = self._lookup(key)
+            if file_id is not None:
+                self.hits += 1
+                for other in keys:
+                    if other != key and other not in self._entries:
+                        self._store(other,file_id)
+                return file_id
+        self.misses += 1
+        return None
+
+    def put (self,keys:list[str],file_id:str):
+        """
+        Caches `file_id` under all of `keys`
+        """
+        for key in keys:
+            self._store(key,file_id)
+
+    def _lookup (self,key) -> str|None:
+        try:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        except KeyError:
+            pass
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT file_id FROM file_ids WHERE key = ?",(key,)).fetchone()
+        if row is None:
+            return None
+        self._store(key,row[0])
+        return row[0]
+
+    def _store (self,key,file_id):
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO file_ids VALUES (?,?,?)",(key,file_id,time()))
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                self._db.execute(
+                    "DELETE FROM file_ids WHERE key NOT IN (SELECT key FROM file_ids ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            self._db.commit()
+
+    def __len__ (self):
+        return len(self._entries)
+
+    def close (self):
+        """
+        close the sqlite database backing the cache
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,101 @@
+"""
+This module contains the flow control of the polling application, which sizes getUpdates batches and
+paces polls to what the handlers can sustain
+"""
+import asyncio
+import math
+
+__all__ = ("FlowControl",)
+
+
+class FlowControl:
+    """
+    Adapts the `limit` and the cadence of getUpdates to the backlog of the application, the updates
+    received but not processed yet, and to the average latency of the handlers.
+
+    - The handlers sustain about `workers / latency` updates per second. A batch is sized to keep them
+      busy for `batch_interval` seconds, between `min_limit` and `max_limit`, and never larger than the
+      room left under `high_water`.
+    - A poll is delayed while the backlog takes more than `batch_interval` seconds to drain, so the next
+      batch arrives about when the handlers are ready for it.
+    - Polling stops when the backlog reaches `high_water` and resumes once it drained to `low_water`,
+      bounding the memory held during spikes whatever the latency estimate.
+
+    Args:
+        high_water (int): backlog at which polling stops. Defaults to 1000.
+        low_water (int): backlog at which polling resumes. Defaults to half of high_water.
+        min_limit (int): smallest batch requested. Defaults to 1.
+        max_limit (int): largest batch requested, at most 100. Defaults to 100.
+        batch_interval (int | float): seconds of handler work a batch is sized for. Defaults to 1.
+        smoothing (float): weight of the latest handler latency in its moving average. Defaults to 0.2.
+    """
+
+    def __init__ (self,high_water = 1000,low_water = None,min_limit = 1,max_limit = 100,batch_interval = 1,smoothing = 0.2):
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.batch_interval = batch_interval
+        self.smoothing = smoothing
+        self.latency = None
+        self.limit = max_limit
+        self.pauses = 0
+        self._drained = asyncio.Event()
+
+    def finished (self,latency = None):
+        """
+        called when an update was processed, with the seconds its handler took
+        """
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+        self._drained.set()
+
+    def drain_time (self,backlog:int,workers:int) -> float:
+        """
+        returns the estimated seconds the handlers take to process backlog updates
+        """
+        if self.latency is None:
+            return 0
+        return backlog * self.latency / workers
+
+    async def acquire (self,backlog,workers:int) -> int:
+        """
+        Waits until the next poll is due and returns its limit.
+        Args:
+            backlog (callable): returns the current number of updates received and not processed yet
+            workers (int): number of updates processed concurrently
+        """
+        if backlog() >= self.high_water:
+            self.pauses += 1
+            while backlog() > self.low_water:
+                self._drained.clear()
+                await self._drained.wait()
+        delay = self.drain_time(backlog(),workers) - self.batch_interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.latency:
+            limit = math.ceil(workers / self.latency * self.batch_interval)
+        else:
+            limit = self.max_limit
+        limit = min(limit,self.max_limit,self.high_water - backlog())
+        self.limit = max(limit,self.min_limit)
+        return self.limit
+
+    def stats (self) -> dict:
+        """
+        Returns the statistics of the flow control.
+        Returns:
+            dict: with the keys
+                latency: moving average of the handler latency in seconds, None before the first update
+                limit: limit of the last poll
+                pauses: number of times polling stopped at the high water mark
+        """
+        return {
+            "latency":self.latency,
+            "limit":self.limit,
+            "pauses":self.pauses,
+        }
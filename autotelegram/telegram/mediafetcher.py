@@ -0,0 +1,161 @@
+"""
+This module contains the media fetcher, a download service for the files of incoming media
+backed by a size capped on disk cache
+"""
+import asyncio
+import os
+from collections import OrderedDict
+
+__all__ = ("MediaFetcher",)
+
+
+class MediaFetcher:
+    """
+    Downloads the files of incoming media such as `Message.photo`, `document`, `video` and `voice`
+    into an on disk cache, keyed by their `file_unique_id`, which is the same for a file across chats.
+
+    - Downloads run over the shared connection pool, at most `concurrency` at once.
+    - Concurrent fetches of one `file_unique_id` share a single download.
+    - Cached files are evicted least recently used first once their total size exceeds `max_bytes`.
+
+    The index of the cache is rebuilt from the directory on start, ordered by modification time,
+    which is refreshed whenever a cached file is used. So the cache survives restarts without an
+    index file that could go out of sync with the directory.
+
+    Args:
+        directory (str | os.PathLike): directory holding the cached files. It is created if missing.
+        max_bytes (int): maximum total size of the cached files. Defaults to 1 GiB.
+        concurrency (int): maximum number of downloads running at once. Defaults to 4.
+    """
+
+    def __init__ (self,directory,max_bytes = 1024 ** 3,concurrency = 4):
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._inflight = {}
+        self._index = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.downloads = 0
+        os.makedirs(self.directory,exist_ok = True)
+        self._load_index()
+
+    def _load_index (self):
+        """
+        rebuild the index from the files in the directory, least recently used first
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns,entry.name,stat.st_size))
+        for _,name,size in sorted(entries):
+            self._index[name] = size
+            self.size += size
+        self._evict()
+
+    def path (self,file_unique_id:str) -> str:
+        """
+        returns the path a file is cached at
+        """
+        return os.path.join(self.directory,file_unique_id)
+
+    async def fetch (self,context,media) -> str:
+        """
+        Returns the path of the cached file of `media`, downloading it with `context` if it is not
+        cached yet. A list of PhotoSize, as found in `Message.photo`, fetches the largest photo.
+        Args:
+            context (Context): context to download the file with
+            media (PhotoSize | list[PhotoSize] | Document | Video | Voice | Audio | Animation | VideoNote | Sticker):
+                any object having a `file_id` and a `file_unique_id`
+        """
+        if isinstance(media,list):
+            media = media[-1]
+        uid = media.file_unique_id
+        if uid in self._index:
+            self.hits += 1
+            self._index.move_to_end(uid)
+            path = self.path(uid)
+            os.utime(path)
+            return path
+        try:
+            future = self._inflight[uid]
+        except KeyError:
+            future = self._inflight[uid] = asyncio.ensure_future(self._download(context,media))
+            future.add_done_callback(lambda _:self._inflight.pop(uid,None))
+        else:
+            self.hits += 1
+        return await asyncio.shield(future)
+
+    async def read (self,context,media) -> bytes:
+        """
+        Returns the contents of the file of `media`, see fetch
+        """
+        path = await self.fetch(context,media)
+        return await asyncio.to_thread(self._read,path)
+
+    @staticmethod
+    def _read (path) -> bytes:
+        with open(path,"rb") as f:
+            return f.read()
+
+    async def _download (self,context,media) -> str:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        uid = media.file_unique_id
+        path = self.path(uid)
+        partial = path + ".part"
+        async with self._semaphore:
+            file = await context.get_file(file_id = media.file_id)
+            try:
+                await context.save_file(file,partial)
+                os.replace(partial,path)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+        self.downloads += 1
+        size = os.path.getsize(path)
+        self._index[uid] = size
+        self.size += size
+        self._evict(keep = uid)
+        return path
+
+    def _evict (self,keep = None):
+        """
+        remove the least recently used files until the cache fits in max_bytes
+        """
+        while self.size > self.max_bytes and self._index:
+            uid,size = next(iter(self._index.items()))
+            if uid == keep:
+                break
+            del self._index[uid]
+            self.size -= size
+            try:
+                os.remove(self.path(uid))
+            except FileNotFoundError:
+                pass
+
+    def stats (self) -> dict:
+        """
+        Returns the statistics of the fetcher.
+        Returns:
+            dict: with the keys
+                files: number of cached files
+                size: total size of the cached files in bytes
+                hits: fetches answered from the cache or by a download already in flight
+                downloads: number of files downloaded
+                in_flight: number of downloads running or waiting
+        """
+        return {
+            "files":len(self._index),
+            "size":self.size,
+            "hits":self.hits,
+            "downloads":self.downloads,
+            "in_flight":len(self._inflight),
+        }
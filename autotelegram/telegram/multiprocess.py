@@ -0,0 +1,285 @@
+"""
+This module contains the multi-process run mode of the polling application: a single poller process
+owns getUpdates and the offset, and feeds the updates to worker processes running the handlers
+"""
+import asyncio
+import multiprocessing
+from multiprocessing.connection import wait
+
+from autotelegram.network.codec import get_codec
+from autotelegram.network.connection import HTTPConnection
+from autotelegram.telegram.dispatcher import Dispatcher,jump_hash,update_key
+
+__all__ = ("ProcessPoller",)
+
+
+class ProcessPoller:
+    """
+    Polls updates in the current process and processes them on `processes` worker processes, so CPU bound
+    handlers can use more than one core.
+
+    - Updates are routed by a consistent hash of their chat id, see `update_key`, so the updates of one chat
+      are always processed by the same worker, in order.
+    - Every worker has a pipe carrying updates as JSON bytes, encoded with the codec of the context, and a
+      pipe carrying back the update_id of every update it finished processing.
+    - The getUpdates offset only advances past updates acknowledged by the workers. Updates returned again
+      while they are still processed are not dispatched twice, and polling pauses until an acknowledgement
+      arrives when a poll brings nothing new, so a slow update holds back at most one `limit` of updates.
+      With an offset store on the context, the acknowledged offset is committed to it.
+    - The stale filter of the application runs in the poller, stale updates are never sent to the workers.
+    - Failed polls are repeated as the retry policy of the application decides, and an update whose handler
+      raises is reported to the error handlers in its worker and acknowledged, like in PollingApp.
+
+    Every worker builds its own context with `context_factory` and processes updates with a copy of the
+    application, with its command and error handlers. The default factory gives the worker contexts the
+    token, base_url, local_mode, codec, retry policy and connection pool settings of the context of app,
+    and a rate limiter with the chat limits of its rate limiter and a `processes`-th of its global budget,
+    see RateLimiter.split, so the workers together stay within the global limit. Other settings, such as
+    the file cache, are not shared. Worker contexts are closed when the workers stop. When the start method of the worker processes is
+    not fork, the callback, the handlers and the factory are pickled, so they must be defined at the top
+    level of a module. An update processed by a worker when the poller stops is not acknowledged, and is
+    received again on the next start.
+
+    Args:
+        app (PollingApp): the application whose handlers process the updates
+        callback (async function): coroutine function to be called for every update
+        processes (int): number of worker processes
+        context_factory (callable): Optional. called without arguments in each worker to build its context,
+            defaults to a context with the settings of the context of app.
+        timeout (int): long polling timeout in seconds. Defaults to 30.
+        limit (int): maximum number of updates fetched by a poll. Defaults to 100.
+        start_method (str): Optional. multiprocessing start method of the workers, see multiprocessing.get_context
+    """
+
+    def __init__ (self,app,callback,processes,context_factory = None,timeout = 30,limit = 100,start_method = None):
+        self.app = app
+        self.callback = callback
+        self.processes = processes
+        if context_factory is None:
+            context_factory = _ContextFactory(app._context,processes)
+        self.context_factory = context_factory
+        self.timeout = timeout
+        self.limit = limit
+        self._mp = multiprocessing.get_context(start_method)
+        self._workers = []
+        self._updates = []
+        self._acks = []
+        self._pending = set()
+        self._next = None
+        self._acked = None
+        self._reader = None
+
+    @property
+    def offset (self) -> int|None:
+        """
+        offset of the next poll: the oldest update not acknowledged yet
+        """
+        if self._pending:
+            return min(self._pending)
+        return self._next
+
+    def start (self):
+        """
+        start the worker processes
+        """
+        for _ in range(self.processes):
+            updates_recv,updates_send = self._mp.Pipe(duplex = False)
+            acks_recv,acks_send = self._mp.Pipe(duplex = False)
+            worker = self._mp.Process(
+                target = _worker_main,
+                args = (self.app,self.callback,self.context_factory,updates_recv,acks_send),
+                daemon = True
+            )
+            worker.start()
+            # the worker ends are only used by the child
+            updates_recv.close()
+            acks_send.close()
+            self._workers.append(worker)
+            self._updates.append(updates_send)
+            self._acks.append(acks_recv)
+
+    async def run (self):
+        """
+        start the workers and poll updates until cancelled
+        Raises:
+            RuntimeError: a worker process exited
+        """
+        context = self.app._context
+        url = context.url.add_method("getUpdates")
+        store = context.offset_store
+        if self._next is None and store is not None and store.update_id is not None:
+            self._next = store.update_id + 1
+        self._acked = asyncio.Event()
+        self.app._callback = self.callback
+        allowed_updates = None
+        self.start()
+        self._reader = asyncio.create_task(self._read_acks())
+        try:
+            while True:
+                params = {"timeout":self.timeout,"limit":self.limit}
+                if self.offset is not None:
+                    params["offset"] = self.offset
+                if self.app.allowed_updates != allowed_updates:
+                    params["allowed_updates"] = self.app.allowed_updates
+                self._acked.clear()
+                updates = await self._guard(self.app._poll(url,params))
+                allowed_updates = params.get("allowed_updates",allowed_updates)
+                if self._next is not None:
+                    # updates below _next were dispatched before and are still being processed
+                    updates = [update for update in updates if update["update_id"] >= self._next]
+                if not updates:
+                    if self._pending:
+                        await self._guard(self._acked.wait())
+                    continue
+                self._next = updates[-1]["update_id"] + 1
+                if self.app.stale_filter is not None:
+                    updates = await self._guard(self.app.stale_filter.filter(updates,context,self.app._report_error))
+
+                batch = []
+                for update in updates:
+                    self._pending.add(update["update_id"])
+                    worker = jump_hash(update_key(update),self.processes)
+                    batch.append((self._updates[worker],context.codec.dumps(update)))
+                if batch:
+                    await self._guard(asyncio.to_thread(_send,batch))
+        finally:
+            await self.close()
+
+    async def _guard (self,aw):
+        """
+        await aw, unless a worker exits first
+        """
+        aw = asyncio.ensure_future(aw)
+        await asyncio.wait((aw,self._reader),return_when = asyncio.FIRST_COMPLETED)
+        if self._reader.done():
+            aw.cancel()
+            self._reader.result()
+        return aw.result()
+
+    async def _read_acks (self):
+        while True:
+            acks = await asyncio.to_thread(_receive,self._acks,1.0)
+            for index,data in acks:
+                if data is None:
+                    raise RuntimeError(f"worker process {self._workers[index].pid} exited")
+                self._pending.difference_update(int(update_id) for update_id in data.split())
+                self._acked.set()
+            store = self.app._context.offset_store
+            if acks and store is not None and self.offset is not None:
+                store.commit(self.offset - 1)
+
+    async def close (self):
+        """
+        stop the worker processes once they processed the updates sent to them
+        """
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader,return_exceptions = True)
+        try:
+            await asyncio.to_thread(_send,[(conn,b"") for conn in self._updates])
+        except OSError:
+            pass
+        for worker in self._workers:
+            await asyncio.to_thread(worker.join,5)
+            if worker.is_alive():
+                worker.terminate()
+        for conn in self._updates + self._acks:
+            conn.close()
+        self._workers,self._updates,self._acks = [],[],[]
+        if self.app._context.offset_store is not None:
+            self.app._context.offset_store.flush()
+
+
+class _ContextFactory:
+    """
+    builds a context in the worker processes, it is picklable unlike the context
+    """
+
+    def __init__ (self,context,processes):
+        self.token = context.url.bot_token
+        self.base_url = context.url.base_url
+        self.local_mode = context.local_mode
+        self.codec = context.codec.name
+        self.retry_policy = context.retry_policy
+        self.rate_limiter = context.rate_limiter.split(processes) if context.rate_limiter else None
+        self.connection = context.connection.options() if isinstance(context.connection,HTTPConnection) else {}
+
+    def __call__ (self):
+        from autotelegram.telegram.context import Context
+        return Context(
+            self.token,
+            base_url = self.base_url,
+            local_mode = self.local_mode,
+            codec = self.codec,
+            connection = HTTPConnection(codec = get_codec(self.codec),**self.connection),
+            rate_limit = self.rate_limiter is not None,
+            rate_limiter = self.rate_limiter,
+            retry_policy = self.retry_policy
+        )
+
+
+def _send (batch):
+    for conn,data in batch:
+        conn.send_bytes(data)
+
+
+def _receive (connections,timeout):
+    """
+    returns the messages ready on connections as (index,data) pairs, data is None for a closed connection
+    """
+    messages = []
+    for conn in wait(connections,timeout):
+        index = connections.index(conn)
+        try:
+            while True:
+                messages.append((index,conn.recv_bytes()))
+                if not conn.poll():
+                    break
+        except EOFError:
+            messages.append((index,None))
+    return messages
+
+
+def _worker_main (app,callback,context_factory,updates,acks):
+    asyncio.run(_worker(app,callback,context_factory,updates,acks))
+
+
+async def _worker (app,callback,context_factory,updates,acks):
+    context = context_factory()
+    app._context = context
+
+    async def process (update):
+        await app._safe_process(update,callback)
+        acks.send_bytes(b"%d" % update.update_id)
+
+    async def parse (data):
+        update = context.codec.loads(data)
+        try:
+            return context.parser.parse(update)
+        except Exception as exp:
+            await app._report_error(exp,update["update_id"])
+            acks.send_bytes(b"%d" % update["update_id"])
+            return None
+
+    dispatcher = None
+    if app.concurrency:
+        dispatcher = Dispatcher(process,app.concurrency,app.queue_size)
+        dispatcher.start()
+
+    try:
+        while True:
+            for _,data in await asyncio.to_thread(_receive,[updates],None):
+                if not data:
+                    return
+                update = await parse(data)
+                if update is None:
+                    continue
+                if dispatcher is None:
+                    await process(update)
+                else:
+                    await dispatcher.submit(update)
+    finally:
+        if dispatcher is not None:
+            await dispatcher.join()
+            await dispatcher.close()
+        await context.aclose()
@@ -22,5 +22,14 @@ class File(BaseObject):
         self.file_unique_id = file_unique_id
         self.file_size: Optional[int] = None
         self.file_path: Optional[str] = None
-        
 
+    async def download (self,destination,**kwargs):
+        """
+        Download this file to `destination` with the current bot context. This method calls
+        download_file under the hood, so you can pass in arguments that are accepted by it.
+        Args:
+            destination (str | os.PathLike): path to save the file to
+        """
+        from autotelegram.telegram.context import get_current_context
+
+        return await get_current_context().download_file(self,destination,**kwargs)
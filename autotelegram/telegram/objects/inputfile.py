@@ -1,5 +1,8 @@
 from autotelegram.telegram.objects.base import BaseObject
 from typing import Optional, TYPE_CHECKING
+import asyncio
+import mimetypes
+import os
 
 if TYPE_CHECKING:
     from autotelegram.telegram.objects.message import MessageEntity
@@ -8,8 +11,58 @@ class InputFile(BaseObject):
     """
     This object represents the contents of a file to be uploaded.
     Must be posted using multipart/form-data in the usual way that files are uploaded via the browser.
+
+    Pass an InputFile wherever the bot API accepts an InputFile, including the `media` and `thumb` of
+    InputMedia objects, and it is streamed to telegram in chunks without reading the whole file into memory.
+
+    Args:
+        file (str | os.PathLike | bytes | bytearray | memoryview | AsyncIterable[bytes]): path of a file on disk,
+            the contents of the file, or an async iterator of its chunks. In memory contents are sent without being copied.
+            An async iterator can only be sent once, so requests uploading one are not repeated on failure.
+        filename (str): Optional. name of the file sent to telegram. Defaults to the name of the path, or "file".
+        mime_type (str): Optional. mime type of the file. Guessed from the filename by default.
+        size (int): Optional. size of the file in bytes. Only needed for async iterators, to send the
+            request with a content length instead of chunked.
+        chunk_size (int): Optional. number of bytes sent at once. Defaults to 256 KiB.
     """
-    
+
+    def __init__ (self,file = None,filename:str = None,mime_type:str = None,size:int = None,chunk_size:int = 256 * 1024) -> None:
+        self.file = file
+        self.chunk_size = chunk_size
+        if isinstance(file,(str,os.PathLike)):
+            self.filename = filename if filename else os.path.basename(file)
+            self.size = os.stat(file).st_size
+        elif isinstance(file,(bytes,bytearray,memoryview)):
+            self.filename = filename if filename else "file"
+            self.size = memoryview(file).nbytes
+        else:
+            self.filename = filename if filename else "file"
+            self.size = size
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+        self.mime_type = mime_type
+
+    @property
+    def replayable (self) -> bool:
+        """
+        True if the file can be sent more than once
+        """
+        return isinstance(self.file,(str,os.PathLike,bytes,bytearray,memoryview))
+
+    async def __aiter__ (self):
+        file = self.file
+        if isinstance(file,(str,os.PathLike)):
+            with open(file,"rb") as f:
+                while chunk := await asyncio.to_thread(f.read,self.chunk_size):
+                    yield chunk
+        elif isinstance(file,(bytes,bytearray,memoryview)):
+            view = memoryview(file).cast("B")
+            for start in range(0,len(view),self.chunk_size):
+                yield view[start:start + self.chunk_size]
+        else:
+            async for chunk in file:
+                yield chunk
+
 class InputMedia(BaseObject):
     """
     This object represents the content of a media message to be sent.
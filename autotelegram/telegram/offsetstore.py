@@ -0,0 +1,143 @@
+"""
+This module contains the offset stores, which persist the highest processed update_id so a restarted
+bot resumes polling where it stopped
+"""
+import os
+import sqlite3
+from abc import ABC,abstractmethod
+from time import monotonic
+
+__all__ = ("OffsetStore","FileOffsetStore","SqliteOffsetStore")
+
+
+class OffsetStore(ABC):
+    """
+    Base class of the offset stores. It keeps the highest processed update_id in memory and writes it
+    out in checkpoints, once `checkpoint_every` updates were committed or `checkpoint_interval` seconds
+    passed since the last checkpoint, whichever comes first. A checkpoint after every update gives the
+    strongest guarantee, less frequent checkpoints save I/O at the cost of processing again the updates
+    committed after the last checkpoint when the process crashes.
+
+    Subclasses implement `_read` and `_write`.
+
+    Args:
+        checkpoint_every (int): number of committed updates between checkpoints. Defaults to 100.
+        checkpoint_interval (int | float): maximum seconds between checkpoints. Defaults to 1.
+    """
+
+    def __init__ (self,checkpoint_every = 100,checkpoint_interval = 1):
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.update_id = None
+        self._dirty = 0
+        self._checkpoint = monotonic()
+        self.checkpoints = 0
+
+    def load (self) -> int|None:
+        """
+        Returns the highest update_id processed before, or None if nothing was stored yet
+        """
+        self.update_id = self._read()
+        return self.update_id
+
+    def commit (self,update_id:int):
+        """
+        Records that every update up to update_id was processed, writing a checkpoint when one is due
+        """
+        if self.update_id is not None and update_id <= self.update_id:
+            return
+        self.update_id = update_id
+        self._dirty += 1
+        if self._dirty >= self.checkpoint_every or monotonic() - self._checkpoint >= self.checkpoint_interval:
+            self.flush()
+
+    def flush (self):
+        """
+        write a checkpoint of the committed update_id if it changed since the last one
+        """
+        if self._dirty:
+            self._write(self.update_id)
+            self.checkpoints += 1
+            self._dirty = 0
+        self._checkpoint = monotonic()
+
+    def close (self):
+        """
+        write a last checkpoint and release the store
+        """
+        self.flush()
+
+    @abstractmethod
+    def _read (self) -> int|None:
+        """
+        abstract read method, returns the stored update_id or None
+        """
+
+    @abstractmethod
+    def _write (self,update_id:int):
+        """
+        abstract write method, stores update_id
+        """
+
+
+class FileOffsetStore(OffsetStore):
+    """
+    Offset store keeping the update_id in a text file. Checkpoints write a temporary file, fsync it
+    and rename it over the previous one, so the file always holds a complete checkpoint.
+
+    Args:
+        path (str | os.PathLike): path of the file
+        checkpoint_every (int): see OffsetStore
+        checkpoint_interval (int | float): see OffsetStore
+    """
+
+    def __init__ (self,path,checkpoint_every = 100,checkpoint_interval = 1):
+        super().__init__(checkpoint_every,checkpoint_interval)
+        self.path = os.fspath(path)
+
+    def _read (self):
+        try:
+            with open(self.path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _write (self,update_id):
+        temporary = self.path + ".tmp"
+        with open(temporary,"w") as f:
+            f.write(str(update_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary,self.path)
+
+
+class SqliteOffsetStore(OffsetStore):
+    """
+    Offset store keeping the update_id in an sqlite database, which can be shared with other data of the bot.
+
+    Args:
+        path (str | os.PathLike): path of the database
+        checkpoint_every (int): see OffsetStore
+        checkpoint_interval (int | float): see OffsetStore
+    """
+
+    def __init__ (self,path,checkpoint_every = 100,checkpoint_interval = 1):
+        super().__init__(checkpoint_every,checkpoint_interval)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA synchronous = FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS update_offset (id INTEGER PRIMARY KEY CHECK (id = 0), update_id INTEGER NOT NULL)")
+        self._db.commit()
+
+    def _read (self):
+        row = self._db.execute("SELECT update_id FROM update_offset WHERE id = 0").fetchone()
+        return None if row is None else row[0]
+
+    def _write (self,update_id):
+        self._db.execute("INSERT OR REPLACE INTO update_offset VALUES (0,?)",(update_id,))
+        self._db.commit()
+
+    def close (self):
+        if self._db is not None:
+            super().close()
+            self._db.close()
+            self._db = None
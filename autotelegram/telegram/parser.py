@@ -1184,6 +1184,10 @@ class Parser:
                 return self._parse_message(msg,json_data)
             case ("user"|"user_profile_photos") as usr:
                 return self._parse_user(usr,json_data)
+            case "file":
+                return self._parse_file(root_object,json_data)
+            case "response_parameters":
+                return self._parse_responseparameters(root_object,json_data)
             case _:
                 return self._parse_update(json_data)
 
@@ -1198,32 +1202,29 @@ class Parser:
 class Composer:
 
     def compose (self,cls):
-
+        """
+        Builds the JSON object of the telegram object `cls`. Attributes set to None and private
+        attributes are left out. Raises TypeError if `cls` is not an object.
+        """
         response_obj = {}
         for k,v in vars(cls).items():
-            try:
-                if isinstance(v,list):
-                    obj_list = []
-                    for obj in v:
-                        resp_obj = self.compose(obj)
-                        obj_list.append(resp_obj)
-                    response_obj[k] = obj_list
-                else:
-                    resp_obj = self.compose(v)
-            except TypeError:
-                if (k == "from_"):
-                    response_obj["from"] = v
-                else:
-                    response_obj[k] = v
+            if k.startswith("_"):
                 continue
+            if (k == "from_"):
+                response_obj["from"] = self._compose_value(v)
             else:
-                if (k == "from_"):
-                    response_obj["from"] = resp_obj
-                else:
-                    response_obj[k] = resp_obj
+                response_obj[k] = self._compose_value(v)
 
         return self._clean(response_obj)
 
+    def _compose_value (self,v):
+        if isinstance(v,list):
+            return [self._compose_value(obj) for obj in v]
+        try:
+            return self.compose(v)
+        except TypeError:
+            return v
+
     def _clean (self,resp:dict) -> dict:
         
         clean_resp = {}
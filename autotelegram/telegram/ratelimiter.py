@@ -0,0 +1,199 @@
+"""
+This module contains the outbound rate limiter used by the context to stay within
+the telegram flood limits.
+"""
+import asyncio
+from collections import deque
+from time import monotonic
+
+__all__ = ("RateLimiter",)
+
+
+class RateLimiter:
+    """
+    Rate limiter for outgoing messages. Telegram allows a bot about 30 messages per second overall,
+    1 message per second to a private chat and 20 messages per minute to a group or channel.
+    The limiter holds a global bucket plus one bucket per chat, keyed on `chat_id`.
+
+    The global bucket is a sliding window: it keeps the send times of its last `rate` messages, and a
+    message is sent no earlier than `period` seconds after the `rate`-th previous one, so a full burst
+    is allowed but no window of `period` seconds ever holds more than `rate` messages. A chat bucket
+    is a single float, the earliest time the chat may be messaged again, and messages to a chat are
+    spaced `period / rate` seconds apart with no burst, which keeps millions of chats compact. Chats
+    that may be messaged again are pruned, so only chats that were messaged recently are kept in memory.
+
+    Requests are never rejected. `acquire` reserves the next free slot of the chat and then of
+    the global bucket and sleeps until it is reached, which keeps messages to a chat in the
+    order they were made.
+
+    Args:
+        global_rate (int): messages allowed per `global_period` across all chats. Defaults to 30.
+        global_period (float): length in seconds of the global window. Defaults to 1.
+        private_rate (int): messages allowed per `private_period` to one private chat. Defaults to 1.
+        private_period (float): length in seconds of the private chat window. Defaults to 1.
+        group_rate (int): messages allowed per `group_period` to one group or channel. Defaults to 20.
+        group_period (float): length in seconds of the group window. Defaults to 60.
+        prune_interval (float): seconds between sweeps dropping idle chats. Defaults to 60.
+    """
+
+    # methods that are not counted as messages by telegram
+    unlimited_methods = frozenset(("sendChatAction",))
+
+    # prefixes of the methods that send messages to a chat
+    limited_prefixes = ("send","copy","forward")
+
+    def __init__ (self,*,
+        global_rate = 30,
+        global_period = 1,
+        private_rate = 1,
+        private_period = 1,
+        group_rate = 20,
+        group_period = 60,
+        prune_interval = 60
+    ):
+        self.global_rate = global_rate
+        self.global_period = global_period
+        self.private_rate = private_rate
+        self.private_period = private_period
+        self.group_rate = group_rate
+        self.group_period = group_period
+        self.prune_interval = prune_interval
+        self._next_prune = monotonic() + prune_interval
+        self._global = deque(maxlen = global_rate)
+        self._chats = {}
+
+        self._requests = 0
+        self._delayed = 0
+        self._total_delay = 0.0
+        self._max_delay = 0.0
+        self._waiting = 0
+        self._peak_waiting = 0
+
+    def split (self,parts:int) -> "RateLimiter":
+        """
+        Returns a new limiter with the same chat limits and a `parts`-th of the global budget, for each of `parts`
+        processes sending messages at once. Every chat should only be messaged by one of the processes.
+        """
+        # whole messages per window, over a window shortened to keep the exact share of the budget
+        rate = max(1,self.global_rate // parts)
+        return RateLimiter(
+            global_rate = rate,
+            global_period = self.global_period * parts * rate / self.global_rate,
+            private_rate = self.private_rate,
+            private_period = self.private_period,
+            group_rate = self.group_rate,
+            group_period = self.group_period,
+            prune_interval = self.prune_interval
+        )
+
+    def limits (self,method:str) -> bool:
+        """
+        Returns True if calls to the telegram `method` count against the flood limits
+        """
+        return method.startswith(self.limited_prefixes) and method not in self.unlimited_methods
+
+    def reserve_chat (self,chat_id) -> float:
+        """
+        Reserve a slot for one message in the bucket of `chat_id` and return the number of
+        seconds to wait before the message may be sent to the chat.
+        """
+        now = monotonic()
+        if now >= self._next_prune:
+            self._prune(now)
+
+        if isinstance(chat_id,str) and not chat_id.startswith("@"):
+            chat_id = int(chat_id)
+        if isinstance(chat_id,str) or chat_id < 0:
+            rate,period = self.group_rate,self.group_period
+        else:
+            rate,period = self.private_rate,self.private_period
+        send_at = max(now,self._chats.get(chat_id,now))
+        self._chats[chat_id] = send_at + period / rate
+        return send_at - now
+
+    def reserve_global (self) -> float:
+        """
+        Reserve a slot for one message in the global bucket and return the number of seconds
+        to wait before the message may be sent.
+        """
+        now = monotonic()
+        return self._reserve(self._global,self.global_rate,self.global_period,now)
+
+    @staticmethod
+    def _reserve (window,rate,period,now) -> float:
+        """
+        Reserve the next send time of a window holding the send times of its last `rate` messages,
+        after the previous reservation and `period` seconds after the rate-th previous one
+        """
+        send_at = now
+        if window:
+            send_at = max(send_at,window[-1])
+            if len(window) == rate:
+                send_at = max(send_at,window[0] + period)
+        window.append(send_at)
+        return send_at - now
+
+    async def acquire (self,chat_id = None):
+        """
+        Wait until a message to `chat_id` can be sent without exceeding the flood limits.
+        The chat bucket is waited on first, so that a message held back by its chat does not
+        hold a slot of the global bucket while it waits.
+        """
+        self._requests += 1
+        delay = 0.0
+        if chat_id is not None:
+            chat_delay = self.reserve_chat(chat_id)
+            if chat_delay > 0:
+                delay += chat_delay
+                await self._wait(chat_delay)
+        global_delay = self.reserve_global()
+        if global_delay > 0:
+            delay += global_delay
+            await self._wait(global_delay)
+        if delay > 0:
+            self._delayed += 1
+            self._total_delay += delay
+            if delay > self._max_delay:
+                self._max_delay = delay
+
+    async def _wait (self,delay):
+        """
+        sleep for `delay` seconds while being counted as waiting
+        """
+        self._waiting += 1
+        if self._waiting > self._peak_waiting:
+            self._peak_waiting = self._waiting
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._waiting -= 1
+
+    def _prune (self,now):
+        """
+        drop the chats that may be messaged again
+        """
+        self._chats = {chat:free_at for chat,free_at in self._chats.items() if free_at > now}
+        self._next_prune = now + self.prune_interval
+
+    def stats (self) -> dict:
+        """
+        Returns the delay and queue statistics of the limiter.
+        Returns:
+            dict: with the keys
+                requests: number of messages that went through the limiter
+                delayed: number of messages that had to wait
+                total_delay: seconds spent waiting by all messages
+                max_delay: longest wait of a single message
+                waiting: number of messages currently waiting
+                peak_waiting: highest number of messages waiting at once
+                tracked_chats: number of chats held by the limiter
+        """
+        return {
+            "requests":self._requests,
+            "delayed":self._delayed,
+            "total_delay":self._total_delay,
+            "max_delay":self._max_delay,
+            "waiting":self._waiting,
+            "peak_waiting":self._peak_waiting,
+            "tracked_chats":len(self._chats),
+        }
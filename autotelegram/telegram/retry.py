@@ -0,0 +1,57 @@
+"""
+This module contains the retry policy the context uses to repeat failed requests
+"""
+import random
+from autotelegram.network.protocol import TransportError
+from autotelegram.telegram.errors import TelegramResultError
+
+__all__ = ("RetryPolicy",)
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is repeated.
+
+    Flood control errors (error code 429) are repeated after exactly the `retry_after` seconds
+    given by telegram in the response parameters. Server errors (error code 500 and above) and
+    transport errors are repeated with jittered exponential backoff. Any other error is raised
+    straight away.
+
+    Args:
+        max_attempts (int): maximum number of attempts made for one request, the first one included, None for no
+            limit. Defaults to 5.
+        base_delay (float): backoff before the second attempt, doubled on every further attempt. Defaults to 0.5.
+        max_delay (float): upper bound of a single backoff. Defaults to 30.
+        deadline (float): seconds a request may spend retrying, counted from the first attempt.
+            No retry is made if it would end after the deadline. Defaults to 60.
+    """
+
+    def __init__ (self,*,max_attempts = 5,base_delay = 0.5,max_delay = 30,deadline = 60):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff (self,attempt:int) -> float:
+        """
+        Returns a random backoff for the given attempt number, using full jitter
+        """
+        # the exponent is capped so that unlimited attempts never overflow the float
+        return random.uniform(0,min(self.max_delay,self.base_delay * 2 ** min(attempt - 1,62)))
+
+    def delay (self,exp:Exception,attempt:int) -> float|None:
+        """
+        Returns the number of seconds to wait before repeating a request that failed with `exp`
+        on attempt number `attempt`, or None if the request should not be repeated.
+        """
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return None
+        if isinstance(exp,TransportError):
+            return self.backoff(attempt)
+        if isinstance(exp,TelegramResultError):
+            if exp.err_code == 429:
+                retry_after = exp.retry_after
+                return retry_after if retry_after is not None else self.backoff(attempt)
+            if exp.err_code >= 500:
+                return self.backoff(attempt)
+        return None
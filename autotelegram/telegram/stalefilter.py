@@ -0,0 +1,91 @@
+"""
+This module contains the stale update filter, which drops or reroutes old updates before they are parsed
+"""
+from time import time
+
+from autotelegram.telegram.dispatcher import update_date
+
+__all__ = ("StaleFilter",)
+
+
+class StaleFilter:
+    """
+    Filter the applications run on the raw update dicts, before the parser builds their objects.
+    An update is stale when its `date`, see `update_date`, is more than `max_age` seconds old, or when
+    `predicate` returns True for it. Stale updates never reach the handlers, they are dropped, or passed
+    to the `route` coroutine function when one is given.
+
+    Args:
+        max_age (int | float): Optional. age in seconds past which an update is stale.
+        predicate (function): Optional. called with every raw update dict not already stale by age,
+            returns True when the update is stale.
+        route (async function): Optional. coroutine function called with the raw stale update dict and the
+            context, instead of dropping the update.
+    """
+
+    def __init__ (self,max_age = None,predicate = None,route = None):
+        self.max_age = max_age
+        self.predicate = predicate
+        self.route = route
+        self.checked = 0
+        self.expired = 0
+        self.matched = 0
+        self.routed = 0
+
+    def is_stale (self,update:dict,now = None) -> bool:
+        """
+        returns True if the raw update is stale, counting it in the statistics
+        """
+        self.checked += 1
+        if self.max_age is not None:
+            date = update_date(update)
+            if date is not None and (now if now is not None else time()) - date > self.max_age:
+                self.expired += 1
+                return True
+        if self.predicate is not None and self.predicate(update):
+            self.matched += 1
+            return True
+        return False
+
+    async def filter (self,updates:list[dict],context,report = None) -> list[dict]:
+        """
+        Returns the updates that are not stale, dropping or routing the stale ones. An exception raised by
+        `route` is passed to the `report` coroutine function with the update_id of the update, so that it
+        only fails that update, or raised when `report` is not given.
+        """
+        now = time()
+        fresh = []
+        for update in updates:
+            if not self.is_stale(update,now):
+                fresh.append(update)
+            elif self.route is not None:
+                self.routed += 1
+                try:
+                    await self.route(update,context)
+                except Exception as exp:
+                    if report is None:
+                        raise
+                    await report(exp,update["update_id"])
+        return fresh
+
+    def stats (self) -> dict:
+        """
+        Returns the statistics of the filter.
+        Returns:
+            dict: with the keys
+                checked: number of updates checked
+                stale: number of stale updates
+                expired: stale updates older than max_age
+                matched: stale updates matched by the predicate
+                dropped: stale updates dropped
+                routed: stale updates passed to route
+        """
+        stale = self.expired + self.matched
+        return {
+            "checked":self.checked,
+            "stale":stale,
+            "expired":self.expired,
+            "matched":self.matched,
+            "dropped":stale - self.routed,
+            "routed":self.routed,
+        }
@@ -0,0 +1,104 @@
+"""
+Compares the request latency of a Context talking to a co-located bot API server over
+TCP loopback and over a Unix domain socket.
+
+A minimal HTTP/1.1 server answering every request with a successful bot API response stands
+in for the bot API server, so the numbers only reflect the transport and client overhead.
+
+usage:
+    python benchmarks/bench_uds.py [requests] [concurrency]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+sys.path.append(os.getcwd())
+
+from autotelegram.network.connection import HTTPConnection
+from autotelegram.telegram.context import Context
+
+BODY = b'{"ok":true,"result":true}'
+RESPONSE = b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: %d\r\n\r\n%s" % (len(BODY),BODY)
+
+
+async def handle (reader,writer):
+    """
+    answer every request on a keep-alive connection with RESPONSE
+    """
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                name,_,value = line.partition(b":")
+                if name.lower() == b"content-length":
+                    length = int(value)
+            if length:
+                await reader.readexactly(length)
+            writer.write(RESPONSE)
+            await writer.drain()
+    except (asyncio.IncompleteReadError,asyncio.CancelledError,ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def measure (ctx,requests,concurrency):
+    """
+    make `requests` calls with `concurrency` calls in flight and return their latencies
+    """
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def worker ():
+        while not queue.empty():
+            queue.get_nowait()
+            start = perf_counter()
+            await ctx.ban_chat_member(chat_id = 1,user_id = 2)
+            latencies.append(perf_counter() - start)
+
+    # warm up the pool so connection setup is not measured
+    await asyncio.gather(*(ctx.ban_chat_member(chat_id = 1,user_id = 2) for _ in range(concurrency)))
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def report (name,latencies,elapsed):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<5} mean {statistics.mean(latencies) * 1e6:8.1f}us  "
+          f"p50 {statistics.median(latencies) * 1e6:8.1f}us  "
+          f"p99 {p99 * 1e6:8.1f}us  "
+          f"{len(latencies) / elapsed:9.0f} req/s")
+
+
+async def main (requests,concurrency):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp,"bot-api.sock")
+        uds_server = await asyncio.start_unix_server(handle,path)
+        tcp_server = await asyncio.start_server(handle,"127.0.0.1",0)
+        port = tcp_server.sockets[0].getsockname()[1]
+
+        transports = (
+            ("tcp",f"http://127.0.0.1:{port}",HTTPConnection()),
+            ("uds","http://localhost",HTTPConnection(uds = path)),
+        )
+        for name,base_url,connection in transports:
+            ctx = Context("123:abc",base_url = base_url,connection = connection,rate_limit = False)
+            start = perf_counter()
+            latencies = await measure(ctx,requests,concurrency)
+            report(name,latencies,perf_counter() - start)
+            await connection.close()
+
+        uds_server.close()
+        tcp_server.close()
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    asyncio.run(main(requests,concurrency))
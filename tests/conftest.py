@@ -0,0 +1,16 @@
+import sys,os
+sys.path.append(os.getcwd())
+
+import httpx
+import pytest
+from autotelegram.network.connection import HTTPConnection
+
+
+@pytest.fixture
+def make_connection ():
+    """
+    returns a function building an HTTPConnection that answers requests with `handler` instead of the network
+    """
+    def make_connection (handler,**kwargs):
+        return HTTPConnection(transport = httpx.MockTransport(handler),**kwargs)
+    return make_connection
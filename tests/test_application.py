@@ -0,0 +1,1091 @@
+import asyncio
+import json
+import multiprocessing
+import pickle
+import sys,os
+import time
+sys.path.append(os.getcwd())
+
+import httpx
+import pytest
+from autotelegram.network.connection import HTTPConnection
+from autotelegram.telegram.application import PollingApp,WebhookApp
+from autotelegram.telegram.catchup import CatchUp
+from autotelegram.telegram.context import Context,TelegramResultError
+from autotelegram.telegram.dispatcher import Dispatcher,jump_hash,update_key
+from autotelegram.telegram.flowcontrol import FlowControl
+from autotelegram.telegram.multiprocess import ProcessPoller
+from autotelegram.telegram.objects import InlineKeyboardButton
+from autotelegram.telegram.offsetstore import FileOffsetStore
+from autotelegram.telegram.retry import RetryPolicy
+from autotelegram.telegram.stalefilter import StaleFilter
+
+
+def update (update_id,chat_id = 1,text = "hi",date = 0):
+    return {
+        "update_id":update_id,
+        "message":{"message_id":update_id,"date":date,"chat":{"id":chat_id,"type":"private"},"text":text},
+    }
+
+
+class TestPollingApp:
+
+    def test_prefetch_overlaps_processing (self,make_connection):
+        batches = [[update(1),update(2)],[update(3)]]
+        polls = []
+        events = []
+
+        async def poll_handler (request):
+            polls.append(dict(request.url.params))
+            events.append("poll")
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx)
+        processed = []
+
+        async def callback (update,context):
+            events.append(update.update_id)
+            await asyncio.sleep(0.01)
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while len(processed) < 3:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert processed == [1,2,3]
+        # the second poll is sent before the first batch is processed
+        assert events.index("poll",1) < events.index(2)
+        assert polls[0] == {"timeout":"30","allowed_updates":"[]"}
+        # updates are only confirmed once processed
+        assert polls[1]["offset"] == "1"
+        assert polls[2]["offset"] == "3"
+
+    def test_short_poll_without_autoincrement (self,make_connection):
+        polls = []
+
+        def poll_handler (request):
+            polls.append(dict(request.url.params))
+            if len(polls) == 1:
+                return httpx.Response(200,json = {"ok":True,"result":[update(10)]})
+            return httpx.Response(200,json = {"ok":True,"result":[]})
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler),offset_autoincrement = False)
+        app = PollingApp(ctx)
+
+        async def callback (update,context):
+            pass
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0,timeout = 0))
+            while len(polls) < 3:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert polls[0] == {"timeout":"0","allowed_updates":"[]"}
+        assert polls[1]["offset"] == "11" and polls[2]["offset"] == "11"
+
+    def test_concurrent_per_chat_order (self,make_connection):
+        batches = [[update(1,chat_id = 1),update(2,chat_id = 1),update(3,chat_id = 4),update(4,chat_id = 1)]]
+
+        async def poll_handler (request):
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx,concurrency = 2)
+        processed = []
+
+        async def callback (update,context):
+            chat_id = update.message.chat.id
+            await asyncio.sleep(0.05 if chat_id == 1 else 0)
+            processed.append((chat_id,update.update_id))
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while len(processed) < 4:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        # chat 4 isn't held back by the slow chat 1, whose updates stay in order
+        assert processed == [(4,3),(1,1),(1,2),(1,4)]
+
+    def test_crash_receives_unprocessed_again (self,make_connection):
+        pending = [update(i,chat_id = i) for i in range(1,11)]
+        polls = []
+
+        async def poll_handler (request):
+            # keeps the updates from the offset on, like telegram
+            params = request.url.params
+            offset = int(params.get("offset",0))
+            polls.append(offset)
+            pending[:] = [item for item in pending if item["update_id"] >= offset]
+            result = pending[:int(params.get("limit",100))]
+            if result or params["timeout"] == "0":
+                return httpx.Response(200,json = {"ok":True,"result":result})
+            await asyncio.sleep(3600)
+
+        processed = []
+
+        async def slow (update,context):
+            if update.update_id > 3:
+                await asyncio.sleep(3600)
+            processed.append(update.update_id)
+
+        async def crash ():
+            app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)),concurrency = 4)
+            runner = asyncio.create_task(app._runner(slow,0))
+            while len(processed) < 3 or polls[-1] != 4:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(crash())
+        # the updates being processed were never confirmed
+        assert sorted(processed) == [1,2,3]
+        assert [item["update_id"] for item in pending] == list(range(4,11))
+        received = []
+
+        async def record (update,context):
+            received.append(update.update_id)
+
+        async def restart ():
+            app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)))
+            runner = asyncio.create_task(app._runner(record,0))
+            while len(received) < 7:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(restart())
+        assert received == list(range(4,11))
+
+    def test_error_isolated_to_update (self,make_connection):
+        batches = [[update(1,chat_id = 1),update(2,chat_id = 1),update(3,chat_id = 4)]]
+
+        async def poll_handler (request):
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx,concurrency = 4)
+        handled = []
+        processed = []
+
+        async def handler (exp):
+            handled.append(exp)
+
+        app.add_errorhandler(LookupError,handler)
+
+        async def callback (update,context):
+            if update.update_id == 1:
+                raise KeyError("boom")
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while len(processed) < 2:
+                await asyncio.sleep(0.01)
+            assert not runner.done()
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert sorted(processed) == [2,3]
+        assert len(handled) == 1 and isinstance(handled[0],KeyError)
+        assert app._offset == 4 and not app._inflight
+
+    def test_unhandled_error_is_reported (self,make_connection):
+        batches = [[update(1),update(2)]]
+
+        async def poll_handler (request):
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx)
+        reported = []
+        processed = []
+
+        async def callback (update,context):
+            if update.update_id == 1:
+                raise ValueError("boom")
+            processed.append(update.update_id)
+
+        async def main ():
+            asyncio.get_running_loop().set_exception_handler(lambda loop,context:reported.append(context))
+            runner = asyncio.create_task(app._runner(callback,0))
+            while not processed:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert processed == [2]
+        assert isinstance(reported[0]["exception"],ValueError)
+
+    def test_error_handler_mro (self):
+        app = PollingApp(Context("123:abc"))
+        handled = []
+        app.add_errorhandler(Exception,lambda exp:handled.append("exception"))
+        app.add_errorhandler(LookupError,lambda exp:handled.append("lookup"))
+        assert asyncio.run(app._handle_error(KeyError()))
+        assert asyncio.run(app._handle_error(ValueError()))
+        assert not asyncio.run(app._handle_error(KeyboardInterrupt()))
+        assert handled == ["lookup","exception"]
+
+    def test_transport_error_reconnects (self,make_connection):
+        polls = []
+
+        async def poll_handler (request):
+            polls.append(request.url.params.get("offset"))
+            if len(polls) <= 2:
+                raise httpx.ConnectError("down")
+            if len(polls) == 3:
+                return httpx.Response(200,json = {"ok":False,"error_code":502,"description":"Bad Gateway"})
+            if len(polls) == 4:
+                return httpx.Response(200,json = {"ok":True,"result":[update(1)]})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        client = ctx.poll_connection.client
+        app = PollingApp(ctx,retry_policy = RetryPolicy(max_attempts = None,base_delay = 0.01))
+        processed = []
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while not processed:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert processed == [1]
+        assert ctx.poll_connection.client is not client
+
+    def test_poll_error_stops_runner (self,make_connection):
+
+        def poll_handler (request):
+            return httpx.Response(200,json = {"ok":False,"error_code":401,"description":"Unauthorized"})
+
+        app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)))
+        with pytest.raises(TelegramResultError):
+            asyncio.run(app._runner(None,0))
+
+    def test_commits_processed_offsets (self,tmp_path,make_connection):
+        store = FileOffsetStore(tmp_path / "offset",checkpoint_every = 1)
+        store.load()
+        store.commit(9)
+        batches = [[update(10,chat_id = 1),update(11,chat_id = 4),update(12,chat_id = 1)]]
+        polls = []
+
+        async def poll_handler (request):
+            polls.append(request.url.params.get("offset"))
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler),offset_store = store)
+        app = PollingApp(ctx,concurrency = 2)
+        release = asyncio.Event()
+        commits = []
+
+        async def callback (update,context):
+            if update.update_id == 10:
+                await release.wait()
+            commits.append((update.update_id,store.update_id))
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while len(commits) < 1:
+                await asyncio.sleep(0.01)
+            # 11 is done but 10 is not, so nothing past 9 is committed
+            assert store.update_id == 9
+            release.set()
+            while len(commits) < 3:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert polls[0] == "10"
+        assert store.update_id == 12
+        assert FileOffsetStore(tmp_path / "offset").load() == 12
+
+
+class TestShutdown:
+
+    def shutdown_context (self,make_connection,batches,polls,**kwargs):
+
+        async def poll_handler (request):
+            polls.append(dict(request.url.params))
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            if request.url.params["timeout"] == "0":
+                return httpx.Response(200,json = {"ok":True,"result":[]})
+            await asyncio.sleep(3600)
+
+        def send_handler (request):
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        return Context("123:abc",poll_connection = make_connection(poll_handler),connection = make_connection(send_handler),**kwargs)
+
+    def test_stop_drains_and_closes (self,tmp_path,make_connection):
+        polls = []
+        store = FileOffsetStore(tmp_path / "offset",checkpoint_every = 1000)
+        ctx = self.shutdown_context(make_connection,[[update(1),update(2),update(3)]],polls,offset_store = store)
+        app = PollingApp(ctx)
+        processed = []
+
+        async def callback (update,context):
+            if update.update_id == 1:
+                app.stop()
+            await asyncio.sleep(0.01)
+            await context.send_chat_action(chat_id = 1,action = "typing")
+            processed.append(update.update_id)
+
+        app.run(callback)
+        assert processed == [1,2,3]
+        # the prefetched long poll is cancelled, the last poll only confirms the processed updates
+        assert polls[-1] == {"offset":"4","limit":"1","timeout":"0"}
+        assert FileOffsetStore(tmp_path / "offset").load() == 3
+        assert ctx.connection.client.is_closed and ctx.poll_connection.client.is_closed
+
+    def test_drain_deadline (self,make_connection):
+        polls = []
+        ctx = self.shutdown_context(make_connection,[[update(1),update(2,chat_id = 4),update(3)]],polls)
+        app = PollingApp(ctx,concurrency = 2,drain_timeout = 0.05)
+        processed = []
+
+        async def callback (update,context):
+            if update.update_id == 1:
+                app.stop()
+                await asyncio.sleep(3600)
+            processed.append(update.update_id)
+
+        async def main ():
+            await asyncio.wait_for(app._runner(callback,0),1)
+
+        asyncio.run(main())
+        assert processed == [2]
+        # update 1 never finished, so it is not confirmed
+        assert polls[-1] == {"offset":"1","limit":"1","timeout":"0"}
+
+    def test_context_manager_waits_for_sends (self,make_connection):
+        sent = []
+
+        async def send_handler (request):
+            await asyncio.sleep(0.05)
+            sent.append(request.url.path)
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        async def main ():
+            async with Context("123:abc",connection = make_connection(send_handler)) as ctx:
+                task = asyncio.create_task(ctx.send_chat_action(chat_id = 1,action = "typing"))
+                await asyncio.sleep(0)
+            assert await task
+            return ctx
+
+        ctx = asyncio.run(main())
+        assert sent == ["/bot123:abc/sendChatAction"]
+        assert ctx.connection.client.is_closed
+
+
+class TestCatchUp:
+
+    def run_catchup (self,make_connection,catchup,batches,stale_filter = None):
+        polls = []
+
+        async def poll_handler (request):
+            params = dict(request.url.params)
+            polls.append(params)
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            if params["timeout"] == "0":
+                return httpx.Response(200,json = {"ok":True,"result":[]})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx,catchup = catchup,stale_filter = stale_filter)
+        processed = []
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while not polls or polls[-1]["timeout"] != "30":
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        return polls,processed
+
+    def test_drains_then_long_polls (self,make_connection):
+        progress = []
+        batches = [[update(i,chat_id = i % 3) for i in range(1,101)],[update(101),update(102)]]
+        polls,processed = self.run_catchup(make_connection,CatchUp(progress = progress.append),batches)
+        assert sorted(processed) == list(range(1,103))
+        assert [p["timeout"] for p in polls] == ["0","0","0","30"]
+        assert all(p["limit"] == "100" for p in polls[:3])
+        assert polls[3]["offset"] == "103" and "limit" not in polls[3]
+        assert progress[-1] == {"batches":2,"received":102,"processed":102,"stale":0,"dropped":0,"summarized":0}
+
+    def test_stale_policies (self,make_connection):
+        now = int(time.time())
+        fresh = lambda: [[update(1,date = now - 7200),update(2,date = now - 5),update(3,date = now - 7200)]]
+
+        _,processed = self.run_catchup(make_connection,CatchUp(stale_after = 3600,stale_policy = "drop"),fresh())
+        assert processed == [2]
+
+        summaries = []
+        async def summarize (updates,context):
+            summaries.append([u.update_id for u in updates])
+        _,processed = self.run_catchup(make_connection,CatchUp(stale_after = 3600,stale_policy = "summarize",summarize = summarize),fresh())
+        assert processed == [2] and summaries == [[1,3]]
+
+        _,processed = self.run_catchup(make_connection,CatchUp(stale_after = 3600),fresh())
+        assert sorted(processed) == [1,2,3]
+
+    def test_stale_filter_batch (self,make_connection):
+        now = int(time.time())
+        progress = []
+        batches = [[update(i,date = now - 600) for i in range(1,101)],[update(i,date = now) for i in range(101,151)]]
+        polls,processed = self.run_catchup(make_connection,CatchUp(progress = progress.append),batches,StaleFilter(max_age = 60))
+        # a batch filtered out entirely doesn't end the catch-up
+        assert sorted(processed) == list(range(101,151))
+        assert [p["timeout"] for p in polls] == ["0","0","0","30"]
+        assert progress[-1]["batches"] == 2 and progress[-1]["received"] == 150
+
+    def test_invalid_policy (self):
+        with pytest.raises(ValueError):
+            CatchUp(stale_policy = "ignore")
+        with pytest.raises(ValueError):
+            CatchUp(stale_policy = "summarize")
+
+
+class TestStaleFilter:
+
+    def test_age_and_predicate (self):
+        now = int(time.time())
+        routed = []
+
+        async def route (update,context):
+            routed.append(update["update_id"])
+
+        stale_filter = StaleFilter(max_age = 60,predicate = lambda update:"edited_message" in update,route = route)
+        callback = {"update_id":3,"callback_query":{"id":"x","from":{"id":5},"message":{"message_id":1,"date":now - 600,"chat":{"id":5}}}}
+        edited = {"update_id":4,"edited_message":update(4,date = now)["message"]}
+        updates = [update(1,date = now - 600),update(2,date = now),callback,edited,{"update_id":5,"poll":{"id":"p"}}]
+        fresh = asyncio.run(stale_filter.filter(updates,None))
+        assert [u["update_id"] for u in fresh] == [2,5]
+        assert routed == [1,3,4]
+        assert stale_filter.stats() == {"checked":5,"stale":3,"expired":2,"matched":1,"dropped":0,"routed":3}
+
+    def test_polling_drops_before_parsing (self,monkeypatch,make_connection):
+        now = int(time.time())
+        batches = [[update(1,date = now - 600),update(2,date = now)]]
+
+        async def poll_handler (request):
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        parsed = []
+        parse = ctx.parser.parse
+        monkeypatch.setattr(ctx.parser,"parse",lambda val,*args:parsed.append(val["update_id"]) or parse(val,*args))
+        app = PollingApp(ctx,stale_filter = StaleFilter(max_age = 60))
+        processed = []
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while not processed:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert processed == [2] and parsed == [2]
+        assert app.stale_filter.stats()["dropped"] == 1
+
+    def test_webhook_drops (self):
+        now = int(time.time())
+        processed = []
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        app = WebhookApp(Context("123:abc"),callback,stale_filter = StaleFilter(max_age = 60))
+
+        async def post (body):
+            messages = [{"type":"http.request","body":json.dumps(body).encode(),"more_body":False}]
+            async def receive ():
+                return messages.pop(0)
+            async def send (message):
+                pass
+            await app({"type":"http","method":"POST","path":"/","headers":[]},receive,send)
+
+        async def main ():
+            await post(update(1,date = now - 600))
+            await post(update(2,date = now))
+
+        asyncio.run(main())
+        assert processed == [2]
+
+    def test_failed_route_only_fails_its_update (self,make_connection):
+        now = int(time.time())
+        batches = [[update(1,date = now - 600),update(2,date = now)]]
+
+        async def poll_handler (request):
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        async def route (update,context):
+            raise ValueError(update["update_id"])
+
+        app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)),stale_filter = StaleFilter(max_age = 60,route = route))
+        failed,processed = [],[]
+        app.add_errorhandler(ValueError,lambda exp:failed.append(exp.args[0]))
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while not processed:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert failed == [1] and processed == [2]
+
+        webhook = WebhookApp(Context("123:abc"),callback,stale_filter = app.stale_filter)
+        webhook.add_errorhandler(ValueError,lambda exp:failed.append(exp.args[0]))
+        assert asyncio.run(post_update(webhook,update(3,date = now - 600))) == 200
+        assert failed == [1,3]
+
+
+async def post_update (app,body,headers = (),method = "POST",chunk_size = None):
+    """
+    send body to the ASGI app, in chunks of chunk_size bytes, returns the status code of the response
+    """
+    body = body if isinstance(body,bytes) else json.dumps(body).encode()
+    chunk_size = chunk_size or len(body) or 1
+    chunks = [body[i:i + chunk_size] for i in range(0,len(body),chunk_size)] or [b""]
+    messages = [{"type":"http.request","body":chunk,"more_body":i < len(chunks) - 1} for i,chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive ():
+        return messages.pop(0)
+
+    async def send (message):
+        sent.append(message)
+
+    await app({"type":"http","method":method,"path":"/","headers":list(headers)},receive,send)
+    return sent[0]["status"]
+
+
+
+class TestWebhookApp:
+
+    def test_acknowledges_before_processing (self):
+        processed = []
+        release = asyncio.Event()
+
+        async def callback (update,context):
+            if update.update_id == 1:
+                await release.wait()
+            processed.append(update.update_id)
+
+        app = WebhookApp(Context("123:abc"),callback,concurrency = 2)
+
+        async def main ():
+            statuses = [await post_update(app,update(i,chat_id = 1 if i < 3 else 4)) for i in (1,2,3)]
+            await asyncio.sleep(0.01)
+            # chat 4 proceeds while chat 1 waits, in order
+            assert processed == [3]
+            release.set()
+            await app.close()
+            return statuses
+
+        assert asyncio.run(main()) == [200,200,200]
+        assert processed == [3,1,2]
+
+    def test_overflow (self):
+
+        async def run (overflow):
+            release = asyncio.Event()
+
+            async def callback (update,context):
+                await release.wait()
+
+            app = WebhookApp(Context("123:abc"),callback,concurrency = 1,queue_size = 1,overflow = overflow)
+            # the first update is being processed, the second is queued
+            await post_update(app,update(1))
+            await asyncio.sleep(0)
+            statuses = [await post_update(app,update(2))]
+            if overflow == "wait":
+                waiting = asyncio.create_task(post_update(app,update(3)))
+                await asyncio.sleep(0.01)
+                assert not waiting.done()
+                release.set()
+                statuses.append(await waiting)
+            else:
+                statuses.append(await post_update(app,update(3)))
+                release.set()
+            await app._dispatcher.join()
+            stats = app.stats()
+            await app.close()
+            return statuses,stats
+
+        statuses,stats = asyncio.run(run("drop"))
+        assert statuses == [200,200] and stats["dropped"] == 1 and stats["processed"] == 2
+        statuses,stats = asyncio.run(run("reject"))
+        assert statuses == [200,503] and stats["rejected"] == 1
+        statuses,stats = asyncio.run(run("wait"))
+        assert statuses == [200,200] and stats["processed"] == 3
+        with pytest.raises(ValueError):
+            WebhookApp(Context("123:abc"),overflow = "block")
+
+    def test_reply_in_response (self,make_connection):
+        requests = []
+
+        def handler (request):
+            requests.append(request.url.path)
+            return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0}})
+
+        async def callback (update,context):
+            button = InlineKeyboardButton("ok")
+            button.callback_data = "1"
+            keyboard = {"inline_keyboard":[[button]]}
+            return await context.defer(context.send_message(chat_id = update.message.chat.id,text = "hi",reply_markup = keyboard))
+
+        async def post (app):
+            messages = [{"type":"http.request","body":json.dumps(update(1,chat_id = 7)).encode(),"more_body":False}]
+            sent = []
+
+            async def receive ():
+                return messages.pop(0)
+
+            async def send (message):
+                sent.append(message)
+
+            await app({"type":"http","method":"POST","path":"/","headers":[]},receive,send)
+            await app.close()
+            return sent
+
+        ctx = Context("123:abc",rate_limit = False,connection = make_connection(handler))
+        sent = asyncio.run(post(WebhookApp(ctx,callback)))
+        assert (b"content-type",b"application/json") in sent[0]["headers"]
+        assert json.loads(sent[1]["body"]) == {
+            "method":"sendMessage","chat_id":7,"text":"hi",
+            "reply_markup":{"inline_keyboard":[[{"text":"ok","callback_data":"1"}]]},
+        }
+        assert requests == []
+
+        # in the background, the request was answered already and the call is sent
+        sent = asyncio.run(post(WebhookApp(ctx,callback,concurrency = 1)))
+        assert sent[1]["body"] == b""
+        assert requests == ["/bot123:abc/sendMessage"]
+
+    def test_invalid_body (self):
+        app = WebhookApp(Context("123:abc"))
+        assert asyncio.run(post_update(app,b"not json")) == 400
+        assert asyncio.run(post_update(app,[1])) == 400
+
+    def test_body_limits (self):
+        processed = []
+
+        async def callback (update,context):
+            processed.append((update.update_id,update.message.text))
+
+        app = WebhookApp(Context("123:abc"),callback,max_body_size = 200)
+        body = json.dumps(update(1)).encode()
+        length = [(b"content-length",str(len(body)).encode())]
+
+        async def main ():
+            return [
+                await post_update(app,body,length,chunk_size = 16),
+                await post_update(app,body),
+                await post_update(app,update(2,text = "x" * 200)),
+                await post_update(app,b"{}",[(b"content-length",b"4096")]),
+                await post_update(app,body,method = "GET"),
+            ]
+
+        assert asyncio.run(main()) == [200,200,413,413,405]
+        assert processed == [(1,"hi"),(1,"hi")]
+
+    def test_secret_token (self,make_connection):
+        processed = []
+
+        async def callback (update,context):
+            processed.append(update.update_id)
+
+        def handler (request):
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        app = WebhookApp(Context("123:abc",connection = make_connection(handler)),callback)
+
+        async def main ():
+            await app.set_webhook("https://example.org/hook",secret_token = "s3cret")
+            return [
+                await post_update(app,update(1)),
+                await post_update(app,update(2),[(b"x-telegram-bot-api-secret-token",b"wrong")]),
+                await post_update(app,update(3),[(b"x-telegram-bot-api-secret-token",b"s3cret")]),
+            ]
+
+        assert asyncio.run(main()) == [403,403,200]
+        assert processed == [3]
+
+    def test_lifespan_shutdown_drains (self):
+        processed = []
+
+        async def callback (update,context):
+            await asyncio.sleep(0.01)
+            processed.append(update.update_id)
+
+        app = WebhookApp(Context("123:abc"),callback,concurrency = 2)
+
+        async def main ():
+            await post_update(app,update(1))
+            messages = [{"type":"lifespan.startup"},{"type":"lifespan.shutdown"}]
+            sent = []
+
+            async def receive ():
+                return messages.pop(0)
+
+            async def send (message):
+                sent.append(message["type"])
+
+            await app({"type":"lifespan"},receive,send)
+            return sent
+
+        assert asyncio.run(main()) == ["lifespan.startup.complete","lifespan.shutdown.complete"]
+        assert processed == [1]
+
+
+class TestAllowedUpdates:
+
+    def test_derived_from_handlers (self):
+        app = PollingApp(Context("123:abc"))
+        assert app.allowed_updates == []
+
+        @app.add_updatehandler("callback_query")
+        async def on_callback (update,context):
+            pass
+
+        app.add_commandhandler("/start")(on_callback)
+        assert app.allowed_updates == ["callback_query","message"]
+        app.remove_commandhandler("/start")
+        assert app.allowed_updates == ["callback_query"]
+        app._callback = on_callback
+        assert app.allowed_updates == []
+        # chat_member is only sent on request, so the types the callback receives are listed with it
+        app.add_updatehandler("chat_member")(on_callback)
+        assert "chat_member" in app.allowed_updates and "message" in app.allowed_updates and "poll" in app.allowed_updates
+
+    def test_polling_sends_changes (self,make_connection):
+        polls = []
+        added = asyncio.Event()
+
+        async def poll_handler (request):
+            polls.append(request.url.params.get("allowed_updates"))
+            if len(polls) == 2:
+                # the poll prefetched before the handler is added
+                await added.wait()
+            if len(polls) < 4:
+                return httpx.Response(200,json = {"ok":True,"result":[]})
+            await asyncio.sleep(3600)
+
+        app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)))
+        handled = []
+
+        @app.add_updatehandler("message")
+        async def on_message (update,context):
+            handled.append(update)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(None,0))
+            while len(polls) < 2:
+                await asyncio.sleep(0.01)
+            app.add_updatehandler("poll_answer")(on_message)
+            added.set()
+            while len(polls) < 4:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        assert polls == ['["message"]',None,'["message","poll_answer"]',None]
+
+    def test_webhook_registration_follows_handlers (self,make_connection):
+        registrations = []
+
+        def handler (request):
+            registrations.append(json.loads(request.content))
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        app = WebhookApp(Context("123:abc",connection = make_connection(handler)))
+
+        async def on_message (update,context):
+            pass
+
+        async def main ():
+            app.add_commandhandler("/start")(on_message)
+            await app.set_webhook("https://example.com/bot",secret_token = "s3cret")
+            app.add_updatehandler("callback_query")(on_message)
+            await app._webhook_task
+
+        asyncio.run(main())
+        assert registrations == [
+            {"secret_token":"s3cret","url":"https://example.com/bot","allowed_updates":["message"]},
+            {"secret_token":"s3cret","url":"https://example.com/bot","allowed_updates":["callback_query","message"]},
+        ]
+
+    def test_failed_webhook_registration_is_repeated (self,make_connection):
+        registrations = []
+
+        def handler (request):
+            registrations.append(json.loads(request.content)["allowed_updates"])
+            if len(registrations) == 2:
+                return httpx.Response(500,json = {"ok":False,"error_code":500,"description":"Internal"})
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        async def on_update (update,context):
+            pass
+
+        app = WebhookApp(Context("123:abc",connection = make_connection(handler)),on_update)
+        errors = []
+
+        async def main ():
+            asyncio.get_running_loop().set_exception_handler(lambda loop,context:errors.append(context["message"]))
+            await app.set_webhook("https://example.com/bot")
+            app.add_updatehandler("chat_member")(on_update)
+            app.add_updatehandler("poll")(on_update)
+            await asyncio.wait([app._webhook_task])
+            assert app._webhook_changed
+            # only one registration runs for concurrent requests
+            await asyncio.gather(*(post_update(app,update(i)) for i in range(3)))
+            await asyncio.wait([app._webhook_task])
+
+        asyncio.run(main())
+        assert errors == ["failed to register the webhook"]
+        assert len(registrations) == 3 and registrations[1] == registrations[2]
+        assert not app._webhook_changed
+
+
+class TestFlowControl:
+
+    def test_limit_follows_latency (self):
+        flow = FlowControl(high_water = 50,batch_interval = 1,smoothing = 1)
+
+        async def main ():
+            limits = [await flow.acquire(lambda:0,4),await flow.acquire(lambda:45,4)]
+            flow.finished(0.5)
+            limits.append(await flow.acquire(lambda:0,4))
+            flow.finished(0.0001)
+            limits.append(await flow.acquire(lambda:0,4))
+            return limits
+
+        # 50 room under high water, then 5 room left, 4 workers at 0.5s sustain 8 a second, fast handlers get all the room
+        assert asyncio.run(main()) == [50,5,8,50]
+
+    def test_pauses_at_high_water (self):
+        flow = FlowControl(high_water = 10,low_water = 4)
+        backlog = [10]
+
+        async def main ():
+            acquire = asyncio.create_task(flow.acquire(lambda:backlog[0],1))
+            for size in (9,7,5):
+                await asyncio.sleep(0.01)
+                backlog[0] = size
+                flow.finished()
+            await asyncio.sleep(0.01)
+            assert not acquire.done()
+            backlog[0] = 4
+            flow.finished()
+            return await acquire
+
+        assert asyncio.run(main()) == 6
+        assert flow.stats()["pauses"] == 1
+
+    def test_delays_poll_while_backlog_drains (self):
+        flow = FlowControl(batch_interval = 0.05)
+        flow.finished(0.01)
+
+        async def main ():
+            start = time.monotonic()
+            await flow.acquire(lambda:10,1)
+            return time.monotonic() - start
+
+        # 10 updates of 10ms take 0.1s, the poll waits until 0.05s of work are left
+        assert 0.04 < asyncio.run(main()) < 0.2
+
+    def test_polling_limits (self,make_connection):
+        polls = []
+        batches = [[update(i) for i in range(1,11)],[update(11)]]
+
+        async def poll_handler (request):
+            polls.append(request.url.params.get("limit"))
+            if batches:
+                return httpx.Response(200,json = {"ok":True,"result":batches.pop(0)})
+            await asyncio.sleep(3600)
+
+        app = PollingApp(Context("123:abc",poll_connection = make_connection(poll_handler)),flow_control = FlowControl(batch_interval = 0.1))
+        processed = []
+
+        async def callback (update,context):
+            await asyncio.sleep(0.02)
+            processed.append(update.update_id)
+
+        async def main ():
+            runner = asyncio.create_task(app._runner(callback,0))
+            while len(polls) < 3:
+                await asyncio.sleep(0.01)
+            runner.cancel()
+            await asyncio.gather(runner,return_exceptions = True)
+
+        asyncio.run(main())
+        # the second poll is prefetched before any latency is known, the third is sized to ~0.1s of 20ms handlers
+        assert polls[:2] == ["100","100"]
+        assert 4 <= int(polls[2]) <= 6
+
+
+class TestDispatcher:
+
+    def test_update_key (self):
+        ctx = Context("123:abc")
+        message = update(1,chat_id = -100)
+        callback = {"update_id":2,"callback_query":{"id":"x","from":{"id":5,"is_bot":False,"first_name":"a"},"chat_instance":"c"}}
+        assert update_key(message) == -100
+        assert update_key(ctx.parser.parse(message)) == -100
+        assert update_key(callback) == 5
+        assert update_key(ctx.parser.parse(callback)) == 5
+        assert update_key({"update_id":3,"poll":{"id":"p"}}) == 3
+
+    def test_queue_bounds_submit (self):
+        release = asyncio.Event()
+
+        async def process (update):
+            await release.wait()
+
+        async def main ():
+            dispatcher = Dispatcher(process,concurrency = 1,queue_size = 1)
+            dispatcher.start()
+            await dispatcher.submit(update(1))
+            await asyncio.sleep(0)
+            await dispatcher.submit(update(2))
+            blocked = asyncio.create_task(dispatcher.submit(update(3)))
+            await asyncio.sleep(0.01)
+            assert not blocked.done()
+            assert dispatcher.stats()["queued"] == [1]
+            release.set()
+            await blocked
+            await dispatcher.join()
+            stats = dispatcher.stats()
+            await dispatcher.close()
+            return stats
+
+        assert asyncio.run(main()) == {"queued":[0],"processed":3,"errors":0}
+
+
+RESULTS = None
+
+async def record_update (update,context):
+    if update.message.chat.id == 1:
+        # slow chat, its updates must stay in order
+        time.sleep(0.05)
+    RESULTS.put((os.getpid(),update.message.chat.id,update.update_id))
+
+
+class TestProcessPoller:
+
+    def test_jump_hash (self):
+        assert [jump_hash(key,4) for key in range(1000)] == [jump_hash(key,4) for key in range(1000)]
+        moved = sum(jump_hash(key,4) != jump_hash(key,5) for key in range(1000))
+        assert moved == sum(jump_hash(key,5) == 4 for key in range(1000))
+
+    def test_workers_ack_before_offset_advances (self,make_connection):
+        global RESULTS
+        RESULTS = multiprocessing.get_context("fork").Queue()
+        telegram_updates = [update(1,chat_id = 1),update(2,chat_id = 4),update(3,chat_id = 1),update(4,chat_id = 1)]
+        offsets = []
+
+        async def poll_handler (request):
+            offset = int(request.url.params.get("offset",0))
+            offsets.append(offset)
+            # like getUpdates, unconfirmed updates are returned again
+            result = [u for u in telegram_updates if u["update_id"] >= offset]
+            if result:
+                return httpx.Response(200,json = {"ok":True,"result":result})
+            await asyncio.sleep(3600)
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler))
+        app = PollingApp(ctx)
+        poller = ProcessPoller(app,record_update,2,start_method = "fork")
+
+        async def main ():
+            task = asyncio.create_task(poller.run())
+            while 5 not in offsets:
+                await asyncio.wait_for(asyncio.shield(asyncio.sleep(0.01)),1)
+                assert not task.done()
+            task.cancel()
+            await asyncio.gather(task,return_exceptions = True)
+
+        asyncio.run(main())
+        results = [RESULTS.get(timeout = 5) for _ in range(4)]
+        assert RESULTS.empty()
+        assert sorted(r[2] for r in results) == [1,2,3,4]
+        assert [r[2] for r in results if r[1] == 1] == [1,3,4]
+        assert len({r[0] for r in results if r[1] == 1}) == 1
+        assert os.getpid() not in {r[0] for r in results}
+        # the offset only moves past the updates of the slow chat as they are processed
+        assert offsets[0] == 0 and offsets[-1] == 5
+        assert offsets == sorted(offsets)
+        assert set(offsets[1:]) <= {1,3,4,5}
+
+    def test_app_pickles_without_context (self):
+        app = PollingApp(Context("123:abc"),concurrency = 2)
+        app.add_commandhandler("/start")(record_update)
+        clone = pickle.loads(pickle.dumps(app))
+        assert clone._context is None
+        assert clone._commandhandlers == {"/start":record_update}
+        assert clone.concurrency == 2
+
+    def test_context_factory (self):
+        policy = RetryPolicy(max_attempts = 3)
+        ctx = Context("123:abc",codec = "json",retry_policy = policy,connection = HTTPConnection(max_connections = 50))
+        poller = ProcessPoller(PollingApp(ctx),record_update,4)
+        worker = pickle.loads(pickle.dumps(poller.context_factory))()
+        assert worker.url.add_method("sendMessage") == "https://api.telegram.org/bot123:abc/sendMessage"
+        assert worker.codec.name == "json"
+        assert worker.retry_policy.max_attempts == 3
+        assert worker.connection.limits.max_connections == 50
+        # the workers share the global budget of 30 messages per second
+        limiter = worker.rate_limiter
+        assert limiter.global_rate * 4 / limiter.global_period == 30
+        assert limiter.group_rate == 20
+        asyncio.run(worker.aclose())
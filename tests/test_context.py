@@ -0,0 +1,657 @@
+import asyncio
+import json
+import sys,os
+from time import monotonic
+from email.parser import BytesParser
+sys.path.append(os.getcwd())
+
+import httpx
+import pytest
+from autotelegram.network.connection import HTTPConnection
+from autotelegram.telegram.context import Context
+from autotelegram.telegram.ratelimiter import RateLimiter
+from autotelegram.telegram.retry import RetryPolicy
+from autotelegram.telegram.filecache import FileIdCache
+from autotelegram.telegram.mediafetcher import MediaFetcher
+from autotelegram.telegram.offsetstore import OffsetStore,FileOffsetStore,SqliteOffsetStore
+from autotelegram.telegram.context import TelegramResultError
+from autotelegram.network.protocol import TransportError
+from autotelegram.telegram.objects import Document,File,InlineKeyboardButton,InputFile,InputMediaPhoto
+from autotelegram.telegram.parser import Composer
+from autotelegram.network.codec import get_codec
+
+
+class TestPollConnection:
+
+    def test_updates_use_poll_connection (self,make_connection):
+        seen = {"send":[],"poll":[]}
+
+        def send_handler (request):
+            seen["send"].append(request.url.path)
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        def poll_handler (request):
+            seen["poll"].append((request.url.path,request.extensions["timeout"]["read"]))
+            return httpx.Response(200,json = {"ok":True,"result":[{"update_id":7}]})
+
+        ctx = Context("123:abc",
+            connection = make_connection(send_handler),
+            poll_connection = make_connection(poll_handler),
+            poll_timeout_margin = 5
+        )
+
+        async def main ():
+            updates = await ctx.get_updates(timeout = 30)
+            await ctx.send_chat_action(chat_id = 1,action = "typing")
+            return updates
+
+        updates = asyncio.run(main())
+        assert updates[0].update_id == 7
+        assert seen["poll"] == [("/bot123:abc/getUpdates",35.0)]
+        assert seen["send"] == ["/bot123:abc/sendChatAction"]
+
+
+class TestUnixSocket:
+
+    def test_connections_share_socket (self,tmp_path):
+        path = str(tmp_path / "bot.sock")
+        ctx = Context("123:abc",base_url = "http://localhost:8081",uds = path)
+        assert ctx.connection.uds == path and ctx.poll_connection.uds == path
+        # the poll connection follows a connection passed with a socket
+        ctx = Context("123:abc",connection = HTTPConnection(uds = path))
+        assert ctx.poll_connection.uds == path
+        assert Context("123:abc").poll_connection.uds is None
+
+
+class TestRateLimiter:
+
+    def test_private_chat_delay (self):
+        limiter = RateLimiter()
+        assert limiter.reserve_chat(42) <= 0
+        assert 0.9 < limiter.reserve_chat(42) <= 1
+        assert limiter.reserve_chat(43) <= 0
+        assert limiter.reserve_chat("43") > 0
+        assert limiter.stats()["tracked_chats"] == 2
+
+    def test_group_pacing (self):
+        limiter = RateLimiter()
+        delays = [limiter.reserve_chat(-100) for _ in range(21)]
+        # 20 messages per minute are spaced 3 seconds apart
+        assert all(abs(delay - 3 * i) < 0.1 for i,delay in enumerate(delays))
+        assert isinstance(limiter._chats[-100],float)
+
+    def test_messages_per_window (self):
+        limiter = RateLimiter()
+        for reserve,rate,period in ((lambda:limiter.reserve_chat(-100),20,60),(limiter.reserve_global,30,1),(lambda:limiter.reserve_chat(7),1,1)):
+            times = [monotonic() + reserve() for _ in range(200)]
+            # no window of period seconds holds more than rate messages
+            assert all(times[i + rate] - times[i] >= period - 1e-3 for i in range(len(times) - rate))
+
+    def test_global_limit (self):
+        limiter = RateLimiter()
+        delays = [limiter.reserve_global() for _ in range(31)]
+        assert all(delay <= 0 for delay in delays[:30])
+        assert delays[30] > 0
+
+    def test_split (self):
+        for parts in (1,4,7,45):
+            limiter = RateLimiter().split(parts)
+            assert limiter.global_rate >= 1 and limiter.private_rate == 1
+            assert abs(limiter.global_rate * parts / limiter.global_period - 30) < 1e-9
+
+    def test_acquire_stats (self):
+        limiter = RateLimiter(private_period = 0.05)
+
+        async def main ():
+            await asyncio.gather(*(limiter.acquire(1) for _ in range(3)))
+
+        asyncio.run(main())
+        stats = limiter.stats()
+        assert stats["requests"] == 3
+        assert stats["delayed"] == 2
+        assert stats["peak_waiting"] == 2
+        assert stats["waiting"] == 0
+        assert 0.09 < stats["max_delay"] <= 0.1
+
+    def test_send_methods_pass_limiter (self,make_connection):
+        def handler (request):
+            if request.url.path.endswith("sendDice"):
+                return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0}})
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        ctx = Context("123:abc",connection = make_connection(handler))
+
+        async def main ():
+            await ctx.send_chat_action(chat_id = 1,action = "typing")
+            await ctx.ban_chat_member(chat_id = 1,user_id = 2)
+            await ctx.send_dice(chat_id = 1)
+
+        asyncio.run(main())
+        assert ctx.rate_limiter.stats()["requests"] == 1
+
+
+def failing_handler (failures):
+    """
+    returns a handler answering with each response in `failures` before succeeding
+    """
+    calls = []
+
+    def handler (request):
+        calls.append(request.url.path)
+        if len(calls) <= len(failures):
+            failure = failures[len(calls) - 1]
+            if isinstance(failure,Exception):
+                raise failure
+            return failure
+        return httpx.Response(200,json = {"ok":True,"result":True})
+
+    return handler,calls
+
+
+class TestRetryPolicy:
+
+    def make_context (self,make_connection,handler,**kwargs):
+        return Context("123:abc",
+            connection = make_connection(handler),
+            rate_limit = False,
+            retry_policy = RetryPolicy(base_delay = 0.001,**kwargs)
+        )
+
+    def test_retry_after_is_parsed (self,make_connection):
+        handler,calls = failing_handler([httpx.Response(429,json = {
+            "ok":False,"error_code":429,"description":"Too Many Requests",
+            "parameters":{"retry_after":7}
+        })])
+        ctx = Context("123:abc",connection = make_connection(handler),rate_limit = False)
+        with pytest.raises(TelegramResultError) as info:
+            asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert info.value.retry_after == 7
+        assert len(calls) == 1
+
+    def test_retries_flood_server_and_transport_errors (self,make_connection):
+        handler,calls = failing_handler([
+            httpx.Response(429,json = {"ok":False,"error_code":429,"description":"","parameters":{"retry_after":0}}),
+            httpx.Response(502,text = "<html>bad gateway</html>"),
+            httpx.ConnectError("refused"),
+            httpx.Response(500,json = {"ok":False,"error_code":500,"description":"Internal"}),
+        ])
+        ctx = self.make_context(make_connection,handler)
+        assert asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert len(calls) == 5
+
+    def test_client_errors_are_not_retried (self,make_connection):
+        handler,calls = failing_handler([httpx.Response(400,json = {"ok":False,"error_code":400,"description":"Bad Request"})])
+        ctx = self.make_context(make_connection,handler)
+        with pytest.raises(TelegramResultError) as info:
+            asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert info.value.err_code == 400
+        assert len(calls) == 1
+
+    def test_deadline_and_attempts (self,make_connection):
+        handler,calls = failing_handler([httpx.Response(429,json = {
+            "ok":False,"error_code":429,"description":"","parameters":{"retry_after":120}
+        })])
+        ctx = self.make_context(make_connection,handler,deadline = 10)
+        with pytest.raises(TelegramResultError) as info:
+            asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert info.value.retry_after == 120
+        assert len(calls) == 1
+
+        handler,calls = failing_handler([httpx.ConnectError("refused")] * 5)
+        ctx = self.make_context(make_connection,handler,max_attempts = 3)
+        with pytest.raises(TransportError):
+            asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert len(calls) == 3
+
+    def test_deadline_scope (self,make_connection):
+        flood = httpx.Response(429,json = {"ok":False,"error_code":429,"description":"","parameters":{"retry_after":0.2}})
+        handler,calls = failing_handler([flood,flood])
+        ctx = Context("123:abc",connection = make_connection(handler),rate_limit = False,retry_policy = RetryPolicy(deadline = 0.1))
+
+        async def main ():
+            with ctx.deadline(1):
+                return await ctx.ban_chat_member(chat_id = 1,user_id = 2)
+
+        with pytest.raises(TelegramResultError):
+            asyncio.run(ctx.ban_chat_member(chat_id = 1,user_id = 2))
+        assert len(calls) == 1
+        # within the scope the call outlives the deadline of the policy
+        assert asyncio.run(main())
+        assert len(calls) == 3
+
+    def test_backoff_of_late_attempts (self):
+        policy = RetryPolicy(max_attempts = None,max_delay = 30)
+        for attempt in (1100,10 ** 6):
+            assert 0 <= policy.backoff(attempt) <= 30
+            assert policy.delay(TransportError("refused"),attempt) <= 30
+
+
+class TestLocalServer:
+
+    def test_base_url (self,make_connection):
+        hosts = []
+
+        def handler (request):
+            hosts.append(str(request.url))
+            return httpx.Response(200,json = {"ok":True,"result":{"file_id":"f","file_unique_id":"u","file_path":"/var/lib/bot/photo.jpg"}})
+
+        ctx = Context("123:abc",base_url = "http://localhost:8081/",connection = make_connection(handler))
+        file = asyncio.run(ctx.get_file(file_id = "f"))
+        assert hosts == ["http://localhost:8081/bot123:abc/getFile"]
+        assert file.file_path == "/var/lib/bot/photo.jpg"
+        assert ctx.url.file_url("photos/a.jpg") == "http://localhost:8081/file/bot123:abc/photos/a.jpg"
+
+    def test_local_mode_reads_from_disk (self,tmp_path,make_connection):
+        source = tmp_path / "photo.jpg"
+        source.write_bytes(b"jpeg-bytes")
+
+        def handler (request):
+            raise AssertionError("local files must not be downloaded")
+
+        ctx = Context("123:abc",local_mode = True,connection = make_connection(handler))
+        file = File("f","u")
+        file.file_path = str(source)
+
+        async def main ():
+            content = await ctx.read_file(file)
+            with content:
+                data = bytes(content)
+            await ctx.save_file(file,tmp_path / "copy.jpg")
+            return data
+
+        assert asyncio.run(main()) == b"jpeg-bytes"
+        assert (tmp_path / "copy.jpg").read_bytes() == b"jpeg-bytes"
+
+    def test_remote_files_are_downloaded (self,tmp_path,make_connection):
+        def handler (request):
+            assert request.url.path == "/file/bot123:abc/photos/a.jpg"
+            return httpx.Response(200,content = b"remote-bytes")
+
+        ctx = Context("123:abc",connection = make_connection(handler))
+        asyncio.run(ctx.save_file("photos/a.jpg",tmp_path / "a.jpg"))
+        assert (tmp_path / "a.jpg").read_bytes() == b"remote-bytes"
+
+
+class TestCodec:
+
+    def test_telegram_objects_in_body (self,make_connection):
+        bodies = []
+
+        def handler (request):
+            bodies.append(json.loads(request.content))
+            return httpx.Response(200,content = b'{"ok":true,"result":{"message_id":3,"date":0}}')
+
+        button = InlineKeyboardButton()
+        button.text = "yes"
+        button.callback_data = "y"
+        ctx = Context("123:abc",codec = "json",connection = make_connection(handler,codec = get_codec("json",default = Composer().compose)))
+        asyncio.run(ctx.send_message(chat_id = 1,text = "sure?",reply_markup = {"inline_keyboard":[[button]]}))
+        assert bodies[0]["reply_markup"] == {"inline_keyboard":[[{"text":"yes","callback_data":"y"}]]}
+        assert ctx.codec.name == "json"
+
+
+class TestInjectedConnection:
+
+    def test_objects_in_body (self):
+        bodies = []
+
+        def handler (request):
+            bodies.append(json.loads(request.content))
+            return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0}})
+
+        # the codec of the connection has no default for telegram objects
+        connection = HTTPConnection(max_connections = 50,transport = httpx.MockTransport(handler))
+        ctx = Context("123:abc",rate_limit = False,connection = connection)
+        button = InlineKeyboardButton("ok")
+        button.callback_data = "1"
+        asyncio.run(ctx.send_message(chat_id = 5,text = "hi",reply_markup = {"inline_keyboard":[[button]]}))
+        assert bodies == [{"chat_id":5,"text":"hi","reply_markup":{"inline_keyboard":[[{"text":"ok","callback_data":"1"}]]}}]
+
+
+class TestUploads:
+
+    def upload_context (self,make_connection,requests):
+        def handler (request):
+            message = BytesParser().parsebytes(b"content-type: " + request.headers["content-type"].encode() + b"\r\n\r\n" + request.content)
+            requests.append({part.get_param("name",header = "content-disposition"):(part.get_filename(),part.get_payload(decode = True))
+                             for part in message.get_payload()})
+            if request.url.path.endswith("sendMediaGroup"):
+                return httpx.Response(200,json = {"ok":True,"result":[{"message_id":1,"date":0}]})
+            return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0}})
+
+        return Context("123:abc",codec = "json",rate_limit = False,connection = make_connection(handler))
+
+    def test_send_photo_from_path (self,tmp_path,make_connection):
+        path = tmp_path / "cat.jpg"
+        path.write_bytes(b"\xff\xd8jpeg")
+        requests = []
+        ctx = self.upload_context(make_connection,requests)
+        asyncio.run(ctx.send_photo(chat_id = 5,photo = InputFile(path),caption = "cat"))
+        assert requests == [{"chat_id":(None,b"5"),"caption":(None,b"cat"),"photo":("cat.jpg",b"\xff\xd8jpeg")}]
+
+    def test_media_group_attachments (self,make_connection):
+        async def chunks ():
+            yield b"second "
+            yield b"photo"
+
+        requests = []
+        ctx = self.upload_context(make_connection,requests)
+        media = [InputMediaPhoto("photo",InputFile(memoryview(b"first photo"),filename = "a.jpg")),
+                 InputMediaPhoto("photo",InputFile(chunks(),filename = "b.jpg")),
+                 InputMediaPhoto("photo","file-id")]
+        asyncio.run(ctx.send_media_group(chat_id = 5,media = media))
+
+        parts = requests[0]
+        assert json.loads(parts["media"][1]) == [{"type":"photo","media":"attach://file0"},
+                                                 {"type":"photo","media":"attach://file1"},
+                                                 {"type":"photo","media":"file-id"}]
+        assert parts["file0"] == ("a.jpg",b"first photo")
+        assert parts["file1"] == ("b.jpg",b"second photo")
+        assert media[0].media.filename == "a.jpg"
+
+
+class TestDefer:
+
+    def test_defer_and_send (self,make_connection):
+        requests = []
+
+        def handler (request):
+            requests.append((request.url.path,json.loads(request.content or b"null")))
+            return httpx.Response(200,json = {"ok":True,"result":{"id":1,"is_bot":True,"first_name":"bot"}})
+
+        ctx = Context("123:abc",rate_limit = False,connection = make_connection(handler))
+
+        async def main ():
+            call = await ctx.defer(ctx.send_message(chat_id = 5,text = "hi"))
+            assert requests == []
+            with pytest.raises(ValueError):
+                await ctx.defer(ctx.get_me())
+            await ctx.send_deferred(call)
+            return call
+
+        call = asyncio.run(main())
+        assert (call.method,call.body) == ("sendMessage",{"chat_id":5,"text":"hi"})
+        assert requests[-1] == ("/bot123:abc/sendMessage",{"chat_id":5,"text":"hi"})
+
+
+class TestDownloads:
+
+    data = bytes(range(256)) * 40
+
+    def download_context (self,make_connection,ranges,fail_after = None,**kwargs):
+        """
+        context whose file server honours range requests, recording them in `ranges`. The first
+        response is cut after `fail_after` bytes when given.
+        """
+        def handler (request):
+            header = request.headers.get("range")
+            ranges.append(header)
+            first,last = 0,len(self.data) - 1
+            if header:
+                first,_,end = header[6:].partition("-")
+                first,last = int(first),int(end) if end else last
+            body = self.data[first:last + 1]
+            status = 206 if header else 200
+
+            if fail_after is not None and len(ranges) == 1:
+                async def broken ():
+                    yield body[:fail_after]
+                    raise httpx.ReadError("connection reset")
+                return httpx.Response(status,content = broken())
+            return httpx.Response(status,content = body)
+
+        return Context("123:abc",connection = make_connection(handler),**kwargs)
+
+    def file (self):
+        file = File("f","u")
+        file.file_path = "documents/file.bin"
+        file.file_size = len(self.data)
+        return file
+
+    def test_download (self,tmp_path,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges)
+        asyncio.run(self.file().download(tmp_path / "file.bin",chunk_size = 1000))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+        assert ranges == [None]
+        assert asyncio.run(ctx.read_file(self.file())) == self.data
+
+    def test_resume_partial_file (self,tmp_path,make_connection):
+        (tmp_path / "file.bin.part").write_bytes(self.data[:4000])
+        ranges = []
+        ctx = self.download_context(make_connection,ranges)
+        asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin"))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+        assert ranges == ["bytes=4000-"]
+        assert not (tmp_path / "file.bin.part").exists()
+
+    def test_replaces_existing_file (self,tmp_path,make_connection):
+        for old in (b"o" * 20000,b"o" * 300):
+            (tmp_path / "file.bin").write_bytes(old)
+            ranges = []
+            ctx = self.download_context(make_connection,ranges)
+            asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin"))
+            assert (tmp_path / "file.bin").read_bytes() == self.data
+            assert ranges == [None]
+
+    def test_resume_after_interruption (self,tmp_path,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges,fail_after = 3000,retry_policy = RetryPolicy(base_delay = 0.001))
+        asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",chunk_size = 1000))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+        assert ranges == [None,"bytes=3000-"]
+
+    def test_resume_failed_download (self,tmp_path,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges,fail_after = 3000)
+        with pytest.raises(TransportError):
+            asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",chunk_size = 1000))
+        assert not (tmp_path / "file.bin").exists()
+        asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",chunk_size = 1000))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+        assert ranges == [None,"bytes=3000-"]
+
+    def test_parallel_ranges (self,tmp_path,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges)
+        asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",parallel = 3,part_size = 4096))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+        assert sorted(ranges) == ["bytes=0-4095","bytes=4096-8191","bytes=8192-10239"]
+
+    def test_failed_parallel_download (self,tmp_path,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges,fail_after = 100)
+        with pytest.raises(TransportError):
+            asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",parallel = 3,part_size = 4096))
+        # nothing is left to be mistaken for a complete file
+        assert list(tmp_path.iterdir()) == []
+        asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin",parallel = 3,part_size = 4096))
+        assert (tmp_path / "file.bin").read_bytes() == self.data
+
+    def test_iter_file (self,make_connection):
+        ranges = []
+        ctx = self.download_context(make_connection,ranges)
+
+        async def main ():
+            return b"".join([chunk async for chunk in ctx.iter_file(self.file(),chunk_size = 512,offset = 10)])
+
+        assert asyncio.run(main()) == self.data[10:]
+        assert ranges == ["bytes=10-"]
+
+    def test_failed_download (self,tmp_path,make_connection):
+        def handler (request):
+            return httpx.Response(404,json = {"ok":False,"error_code":404,"description":"Not Found"})
+
+        ctx = Context("123:abc",connection = make_connection(handler))
+        with pytest.raises(TelegramResultError):
+            asyncio.run(ctx.download_file(self.file(),tmp_path / "file.bin"))
+        with pytest.raises(TelegramResultError):
+            asyncio.run(ctx.read_file(self.file()))
+
+
+class TestFileIdCache:
+
+    def cache_context (self,make_connection,sent,**kwargs):
+        def handler (request):
+            if request.headers["content-type"].startswith("multipart"):
+                sent.append("upload")
+            else:
+                sent.append(json.loads(request.content)["photo"])
+            return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0,
+                "photo":[{"file_id":"small","file_unique_id":"s"},{"file_id":"large","file_unique_id":"l"}]}})
+
+        return Context("123:abc",rate_limit = False,connection = make_connection(handler),**kwargs)
+
+    def test_reuses_file_id (self,tmp_path,make_connection):
+        path = tmp_path / "cat.jpg"
+        path.write_bytes(b"cat")
+        sent = []
+        ctx = self.cache_context(make_connection,sent,file_cache = FileIdCache())
+
+        async def main ():
+            await ctx.send_photo(chat_id = 1,photo = InputFile(path))
+            await ctx.send_photo(chat_id = 2,photo = InputFile(path))
+            await ctx.send_photo(chat_id = 3,photo = InputFile(b"cat",filename = "other.jpg"))
+            await ctx.send_photo(chat_id = 4,photo = InputFile(b"dog"))
+
+        asyncio.run(main())
+        assert sent == ["upload","large","large","upload"]
+        assert ctx.file_cache.hits == 2
+
+    def test_concurrent_sends_upload_once (self,tmp_path,make_connection):
+        path = tmp_path / "cat.jpg"
+        path.write_bytes(b"cat")
+        sent = []
+        ctx = self.cache_context(make_connection,sent,file_cache = FileIdCache())
+        photo = InputFile(path)
+
+        async def main ():
+            await asyncio.gather(*(ctx.send_photo(chat_id = i,photo = photo) for i in range(50)))
+
+        asyncio.run(main())
+        assert sent == ["upload"] + ["large"] * 49
+        assert ctx._uploads == {}
+
+    def test_failed_upload_is_repeated (self,tmp_path,make_connection):
+        sent = []
+
+        def handler (request):
+            if not request.headers["content-type"].startswith("multipart"):
+                sent.append(json.loads(request.content)["photo"])
+            elif sent:
+                sent.append("upload")
+            else:
+                sent.append("failed")
+                return httpx.Response(400,json = {"ok":False,"error_code":400,"description":"Bad Request"})
+            return httpx.Response(200,json = {"ok":True,"result":{"message_id":1,"date":0,"photo":[{"file_id":"large","file_unique_id":"l"}]}})
+
+        ctx = Context("123:abc",rate_limit = False,file_cache = FileIdCache(),connection = make_connection(handler))
+
+        async def main ():
+            return await asyncio.gather(*(ctx.send_photo(chat_id = i,photo = InputFile(b"cat")) for i in range(5)),return_exceptions = True)
+
+        results = asyncio.run(main())
+        assert isinstance(results[0],TelegramResultError)
+        assert sent == ["failed","upload","large","large","large"]
+
+    def test_lru_eviction (self):
+        cache = FileIdCache(max_entries = 2)
+        cache.put(["a"],"1")
+        cache.put(["b"],"2")
+        assert cache.get(["a"]) == "1"
+        cache.put(["c"],"3")
+        assert cache.get(["b"]) is None
+        assert cache.get(["a"]) == "1"
+        assert len(cache) == 2
+
+    def test_persistent_cache (self,tmp_path):
+        cache = FileIdCache(path = tmp_path / "files.db")
+        cache.put(["photo:sha256:abc"],"file-1")
+        cache.close()
+        cache = FileIdCache(path = tmp_path / "files.db")
+        assert cache.get(["photo:sha256:abc"]) == "file-1"
+        cache.close()
+
+
+class TestMediaFetcher:
+
+    def fetch_context (self,make_connection,requests,directory,**kwargs):
+        def handler (request):
+            requests.append(request.url.path)
+            if request.url.path.endswith("getFile"):
+                file_id = json.loads(request.content)["file_id"]
+                return httpx.Response(200,json = {"ok":True,"result":{"file_id":file_id,"file_unique_id":file_id,"file_path":f"files/{file_id}"}})
+            return httpx.Response(200,content = request.url.path.rpartition("/")[2].encode() * 100)
+
+        return Context("123:abc",connection = make_connection(handler),media_fetcher = MediaFetcher(directory,**kwargs))
+
+    def media (self,uid):
+        document = Document()
+        document.file_id = document.file_unique_id = uid
+        return document
+
+    def test_singleflight_and_cache (self,tmp_path,make_connection):
+        requests = []
+        ctx = self.fetch_context(make_connection,requests,tmp_path)
+
+        async def main ():
+            paths = await asyncio.gather(*(ctx.fetch_media(self.media("a")) for _ in range(5)))
+            data = await ctx.read_media(self.media("a"))
+            return paths,data
+
+        paths,data = asyncio.run(main())
+        assert len(set(paths)) == 1
+        assert data == b"a" * 100
+        assert requests == ["/bot123:abc/getFile","/file/bot123:abc/files/a"]
+        assert ctx.media_fetcher.stats()["downloads"] == 1
+
+    def test_lru_eviction_and_reload (self,tmp_path,make_connection):
+        requests = []
+        ctx = self.fetch_context(make_connection,requests,tmp_path,max_bytes = 250)
+
+        async def main ():
+            for uid in ("a","b","a","c"):
+                await ctx.fetch_media(self.media(uid))
+
+        asyncio.run(main())
+        assert sorted(os.listdir(tmp_path)) == ["a","c"]
+        fetcher = MediaFetcher(tmp_path,max_bytes = 250)
+        assert fetcher.stats()["files"] == 2
+        assert fetcher.size == 200
+
+
+class TestOffsetStore:
+
+    @pytest.mark.parametrize("store_class",[FileOffsetStore,SqliteOffsetStore])
+    def test_checkpoints (self,tmp_path,store_class):
+        path = tmp_path / "offset"
+        store = store_class(path,checkpoint_every = 3,checkpoint_interval = 3600)
+        assert store.load() is None
+        store.commit(10)
+        store.commit(11)
+        assert store_class(path).load() is None
+        store.commit(9)
+        store.commit(12)
+        assert store.checkpoints == 1
+        assert store_class(path).load() == 12
+        store.commit(13)
+        store.close()
+        assert store_class(path).load() == 13
+
+    def test_base_store_is_abstract (self):
+        with pytest.raises(TypeError):
+            OffsetStore()
+
+    def test_seeds_context (self,tmp_path,make_connection):
+        store = FileOffsetStore(tmp_path / "offset",checkpoint_every = 1)
+        store.load()
+        store.commit(41)
+        offsets = []
+
+        def poll_handler (request):
+            offsets.append(request.url.params.get("offset"))
+            return httpx.Response(200,json = {"ok":True,"result":[]})
+
+        ctx = Context("123:abc",poll_connection = make_connection(poll_handler),offset_store = FileOffsetStore(tmp_path / "offset"))
+        asyncio.run(ctx.get_updates())
+        assert offsets == ["42"]
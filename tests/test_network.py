@@ -0,0 +1,205 @@
+import asyncio
+import json
+import sys,os
+from email.parser import BytesParser
+sys.path.append(os.getcwd())
+
+import httpx
+import pytest
+from autotelegram.network.codec import JSONCodec,get_codec
+from autotelegram.network.connection import HTTPConnection
+from autotelegram.network.urlmanager import UrlManager
+from autotelegram.network.multipart import MultipartStream
+
+
+def ok_handler (request):
+    return httpx.Response(200,json = {"ok":True,"result":request.url.path})
+
+
+class TestHTTPConnection:
+
+    def test_pool_policy (self):
+        conn = HTTPConnection(max_connections = 10,max_keepalive_connections = 4,keepalive_expiry = 30,read_timeout = 60)
+        assert conn.limits.max_connections == 10
+        assert conn.limits.max_keepalive_connections == 4
+        assert conn.limits.keepalive_expiry == 30
+        assert conn.timeout.read == 60
+        assert conn.timeout.connect == 5.0
+
+    def test_pool_stats (self):
+        conn = HTTPConnection(max_connections = 8,transport = httpx.MockTransport(ok_handler))
+
+        async def main ():
+            await asyncio.gather(*(conn.post("https://example.org/botx/sendMessage",body = {"a":1}) for _ in range(5)))
+            body = await conn.get("https://example.org/botx/getMe")
+            await conn.close()
+            return body
+
+        body = asyncio.run(main())
+        assert json.loads(body)["result"] == "/botx/getMe"
+        stats = conn.pool_stats()
+        assert stats["requests"] == 6
+        assert stats["in_flight"] == 0
+        assert stats["max_connections"] == 8
+        # the pool of a custom transport is unknown
+        assert stats["connections"] is None and stats["idle_connections"] is None
+        pooled = HTTPConnection()
+        assert pooled.pool_stats()["connections"] == 0
+        asyncio.run(pooled.close())
+
+    def test_post_without_body (self):
+        conn = HTTPConnection(transport = httpx.MockTransport(ok_handler))
+        body = asyncio.run(conn.post("https://example.org/botx/close"))
+        assert json.loads(body)["ok"]
+
+    def test_reset (self):
+        pooled = HTTPConnection()
+        mocked = HTTPConnection(transport = httpx.MockTransport(ok_handler))
+        transport,client = pooled._transport,mocked.client
+
+        async def main ():
+            await pooled.reset()
+            await mocked.reset()
+            body = await mocked.get("https://example.org/botx/getMe")
+            await pooled.close()
+            await mocked.close()
+            return body
+
+        body = asyncio.run(main())
+        # a new pool is opened, a custom transport is kept
+        assert pooled._transport is not transport
+        assert mocked.client is not client and client.is_closed
+        assert json.loads(body)["result"] == "/botx/getMe"
+
+
+class TestUrlManager:
+
+    def test_method_urls (self):
+        url = UrlManager("123:abc")
+        assert url.add_method("getMe") == "https://api.telegram.org/bot123:abc/getMe"
+        assert url.add_method("sendMessage") == "https://api.telegram.org/bot123:abc/sendMessage"
+        assert url.add_method("getMe") is url.add_method("getMe")
+        assert url.url == "https://api.telegram.org/bot123:abc/"
+        assert url.bot_token == "123:abc"
+
+    def test_add_query (self):
+        url = UrlManager("123:abc")
+        assert url.add_query(url.add_method("getUpdates"),offset = 5,limit = 10) == "https://api.telegram.org/bot123:abc/getUpdates?offset=5&limit=10"
+
+
+class TestUnixSocket:
+
+    def test_request_over_uds (self,tmp_path):
+        path = str(tmp_path / "bot-api.sock")
+        body = b'{"ok":true,"result":true}'
+
+        async def handle (reader,writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\ncontent-length: %d\r\nconnection: close\r\n\r\n%s" % (len(body),body))
+            await writer.drain()
+            writer.close()
+
+        async def main ():
+            server = await asyncio.start_unix_server(handle,path)
+            conn = HTTPConnection(uds = path)
+            content = await conn.get("http://localhost/bot123:abc/getMe")
+            await conn.close()
+            server.close()
+            return content
+
+        assert asyncio.run(main()) == body
+
+
+class TestCodec:
+
+    class Point:
+        def __init__ (self):
+            self.x = 1
+            self.y = None
+
+    def compose (self,obj):
+        if isinstance(obj,self.Point):
+            return {k:v for k,v in vars(obj).items() if v is not None}
+        raise TypeError
+
+    def test_codecs_roundtrip_bytes (self):
+        for name in ("json","orjson","msgspec"):
+            try:
+                codec = get_codec(name,default = self.compose)
+            except ImportError:
+                continue
+            data = codec.dumps({"text":"héllo","point":self.Point(),"ids":[1,2]})
+            assert isinstance(data,bytes)
+            assert codec.loads(data) == {"text":"héllo","point":{"x":1},"ids":[1,2]}
+
+    def test_unknown_codec (self):
+        with pytest.raises(ValueError):
+            get_codec("yaml")
+
+    def test_post_encodes_with_codec (self):
+        seen = []
+
+        def handler (request):
+            seen.append((request.headers["content-type"],request.content))
+            return httpx.Response(200,json = {"ok":True,"result":True})
+
+        conn = HTTPConnection(codec = JSONCodec(),transport = httpx.MockTransport(handler))
+        asyncio.run(conn.post("https://example.org/botx/sendMessage",body = {"chat_id":1}))
+        assert seen == [("application/json",b'{"chat_id":1}')]
+
+
+class UploadFile:
+
+    def __init__ (self,chunks,filename = "a.bin",mime_type = "application/octet-stream",size = None):
+        self.chunks = chunks
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size = size
+
+    async def __aiter__ (self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def parse_multipart (content_type,body):
+    message = BytesParser().parsebytes(b"content-type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return {part.get_param("name",header = "content-disposition"):(part.get_filename(),part.get_payload(decode = True)) for part in message.get_payload()}
+
+
+class TestMultipart:
+
+    def test_content_length (self):
+        stream = MultipartStream({"chat_id":b"1"},{"photo":UploadFile([b"ab",memoryview(b"cd")],size = 4)})
+
+        async def read ():
+            return b"".join([bytes(chunk) async for chunk in stream])
+
+        body = asyncio.run(read())
+        assert stream.content_length == len(body)
+        assert parse_multipart(stream.content_type,body) == {"chat_id":(None,b"1"),"photo":("a.bin",b"abcd")}
+        assert MultipartStream({},{"photo":UploadFile([b"ab"])}).content_length is None
+
+    def test_streamed_upload (self):
+        received = []
+
+        async def handle (reader,writer):
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = dict(line.split(b": ",1) for line in head.split(b"\r\n")[1:-2])
+            received.append((headers,await reader.readexactly(int(headers[b"content-length"]))))
+            writer.write(b"HTTP/1.1 200 OK\r\ncontent-length: 2\r\nconnection: close\r\n\r\n{}")
+            await writer.drain()
+            writer.close()
+
+        async def main ():
+            server = await asyncio.start_server(handle,"127.0.0.1",0)
+            port = server.sockets[0].getsockname()[1]
+            conn = HTTPConnection()
+            files = {"document":UploadFile([memoryview(b"x" * 1000)] * 3,filename = "a.txt",mime_type = "text/plain",size = 3000)}
+            await conn.post(f"http://127.0.0.1:{port}/botx/sendDocument",body = {"chat_id":1,"caption":"hi"},files = files)
+            await conn.close()
+            server.close()
+
+        asyncio.run(main())
+        headers,body = received[0]
+        parts = parse_multipart(headers[b"content-type"].decode(),body)
+        assert parts == {"chat_id":(None,b"1"),"caption":(None,b"hi"),"document":("a.txt",b"x" * 3000)}